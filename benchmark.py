@@ -0,0 +1,211 @@
+"""Micro-benchmarks for the data pipeline and the model.
+
+Run a benchmark with
+  python benchmark.py --bench tokenizer --input corpus/test.txt.in
+  python benchmark.py --bench graph --num_buckets 8
+  python benchmark.py --bench cells --max_length 48 --batch_size 64
+  python benchmark.py --bench towers --max_length 48
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import seq2seq_model
+import utils.data_utils as data_utils
+import utils.tokenizer_utils as tokenizer_utils
+from tensorflow.python.platform import gfile
+
+tf.app.flags.DEFINE_string("bench", "tokenizer", "which benchmark to run. accepts tokenizer, graph, cells, towers.")
+tf.app.flags.DEFINE_string("input", "corpus/test.txt.in", "input text file for the data benchmarks.")
+tf.app.flags.DEFINE_integer("repeats", 5, "number of timed runs; the best one is reported.")
+tf.app.flags.DEFINE_string("config", "models/config.json", "config file whose model section the model benchmarks use.")
+tf.app.flags.DEFINE_integer("num_buckets", 8, "number of buckets of the model benchmarks.")
+tf.app.flags.DEFINE_integer("max_length", 48, "encoder size of the largest bucket of the model benchmarks.")
+tf.app.flags.DEFINE_integer("batch_size", 64, "batch size of the cell benchmark.")
+tf.app.flags.DEFINE_integer("steps", 20, "number of timed training steps per run of the cell and tower benchmarks.")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def _time(f, repeats):
+  best = float("inf")
+  for _ in range(repeats):
+    start = time.time()
+    f()
+    best = min(best, time.time() - start)
+  return best
+
+
+def bench_tokenizer():
+  """Checks fast_tokenizer against basic_tokenizer and times both."""
+  with gfile.GFile(FLAGS.input, mode="r") as f:
+    lines = f.readlines()
+
+  def basic(line, normalize_digits):
+    words = data_utils.basic_tokenizer(line)
+    if normalize_digits:
+      words = [data_utils._DIGIT_RE.sub("0", w) for w in words]  # pylint: disable=protected-access
+    return words
+
+  print("fast_tokenizer matches basic_tokenizer on %d lines."
+        % tokenizer_utils.check_fast_tokenizer(lines))
+
+  num_tokens = sum(len(basic(line, True)) for line in lines)
+  basic_time = _time(lambda: [basic(line, True) for line in lines],
+                     FLAGS.repeats)
+  fast_time = _time(lambda: [data_utils.fast_tokenizer(line, True)
+                             for line in lines], FLAGS.repeats)
+  for name, elapsed in (("basic_tokenizer", basic_time),
+                        ("fast_tokenizer", fast_time)):
+    print("%-16s %8.1f ms %10.0f lines/sec %10.0f tokens/sec"
+          % (name, elapsed * 1000, len(lines) / elapsed, num_tokens / elapsed))
+  print("speedup: %.2fx" % (basic_time / fast_time))
+
+
+def _model_config():
+  with open(FLAGS.config) as config_file:
+    return json.load(config_file)["model"]
+
+
+def _buckets():
+  """num_buckets evenly spaced buckets [L, L + 1] up to max_length."""
+  return [[FLAGS.max_length * (i + 1) // FLAGS.num_buckets,
+           FLAGS.max_length * (i + 1) // FLAGS.num_buckets + 1]
+          for i in range(FLAGS.num_buckets)]
+
+
+def _build_model(config, buckets, **kwargs):
+  """Builds a training Seq2SeqModel from the model section of a config."""
+  return seq2seq_model.Seq2SeqModel(
+      config["en_vocab_size"], config["fr_vocab_size"], buckets,
+      config["size"], config["num_layers"], config["latent_dim"],
+      max_gradient_norm=5.0, batch_size=32, learning_rate=0.001,
+      kl_rate_rise_factor=config.get("kl_rate_rise_factor"),
+      use_lstm=config["use_lstm"],
+      optimizer=tf.train.AdamOptimizer(0.001),
+      bidirectional=config["bidirectional"],
+      weight_initializer=tf.orthogonal_initializer,
+      bias_initializer=tf.zeros_initializer,
+      iaf=config["iaf"],
+      **kwargs)
+
+
+def bench_graph():
+  """Compares the graph per bucket with the single graph for all buckets."""
+  config = _model_config()
+  buckets = _buckets()
+  print("buckets: %s" % buckets)
+  for name, kwargs in (("per-bucket", {}),
+                       ("fused loss", {"fused_loss": True}),
+                       ("dynamic encoder", {"dynamic_encoder": True}),
+                       ("single graph", {"single_graph": True})):
+    graph = tf.Graph()
+    start = time.time()
+    with graph.as_default():
+      _build_model(config, buckets, **kwargs)
+    elapsed = time.time() - start
+    graph_def = graph.as_graph_def()
+    print("%-16s %8d ops %8.1f MB graph def %8.1f s to build"
+          % (name, len(graph_def.node), graph_def.ByteSize() / 2.0**20,
+             elapsed))
+
+
+def bench_cells():
+  """Times training steps of the default and the block cells on CPU.
+
+  Every cell runs forward and backward over max_length steps of batch_size
+  random inputs of the configured size, as in the encoder.
+  """
+  config = _model_config()
+  size = config["size"]
+  cells = [
+      ("GRUCell", lambda: tf.nn.rnn_cell.GRUCell(size)),
+      ("GRUBlockCell", lambda: tf.contrib.rnn.GRUBlockCell(size)),
+      ("BasicLSTMCell", lambda: tf.nn.rnn_cell.BasicLSTMCell(size)),
+      ("LSTMBlockCell", lambda: tf.contrib.rnn.LSTMBlockCell(size)),
+  ]
+  num_tokens = FLAGS.batch_size * FLAGS.max_length
+  print("size %d, batch size %d, %d steps per sequence"
+        % (size, FLAGS.batch_size, FLAGS.max_length))
+  for name, make_cell in cells:
+    graph = tf.Graph()
+    with graph.as_default(), tf.device("/cpu:0"):
+      inputs = tf.random_normal([FLAGS.batch_size, FLAGS.max_length, size])
+      outputs, _ = tf.nn.dynamic_rnn(make_cell(), inputs, dtype=tf.float32)
+      train_op = tf.train.GradientDescentOptimizer(0.001).minimize(
+          tf.reduce_sum(outputs))
+      init_op = tf.global_variables_initializer()
+    with tf.Session(graph=graph) as sess:
+      sess.run(init_op)
+      sess.run(train_op)  # Warm up.
+
+      def run_steps():
+        for _ in range(FLAGS.steps):
+          sess.run(train_op)
+      elapsed = _time(run_steps, FLAGS.repeats) / FLAGS.steps
+    print("%-14s %8.2f steps/sec %10.0f tokens/sec"
+          % (name, 1 / elapsed, num_tokens / elapsed))
+
+
+def bench_towers():
+  """Times training steps of the model with 1, 2 and 4 towers on CPU.
+
+  Every tower runs on a CPU device of its own (device_count CPU=k), as in
+  training. The devices share the one intra-op thread pool of the process,
+  so this measures what splitting the graph gains, not separate threads.
+  """
+  config = _model_config()
+  buckets = [[FLAGS.max_length, FLAGS.max_length + 1]]
+  rng = np.random.RandomState(0)
+  # _build_model uses batches of 32 examples filling the bucket.
+  data_set = [[
+      [rng.randint(data_utils.UNK_ID + 1, config["en_vocab_size"],
+                   size=FLAGS.max_length - 1).tolist(),
+       rng.randint(data_utils.UNK_ID + 1, config["fr_vocab_size"],
+                   size=FLAGS.max_length - 1).tolist() + [data_utils.EOS_ID]]
+      for _ in range(32)]]
+  print("bucket %s, batch size 32" % buckets[0])
+  for num_towers in (1, 2, 4):
+    graph = tf.Graph()
+    with graph.as_default():
+      model = _build_model(config, buckets, num_towers=num_towers)
+      init_op = tf.global_variables_initializer()
+    session_config = tf.ConfigProto(device_count={"CPU": num_towers})
+    with tf.Session(graph=graph, config=session_config) as sess:
+      sess.run(init_op)
+      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
+          data_set, 0)
+
+      def run_steps():
+        for _ in range(FLAGS.steps):
+          model.step(sess, encoder_inputs, decoder_inputs, target_weights, 0,
+                     False, True)
+      run_steps()  # Warm up.
+      elapsed = _time(run_steps, FLAGS.repeats) / FLAGS.steps
+    print("%d towers %8.2f steps/sec %10.0f examples/sec"
+          % (num_towers, 1 / elapsed, 32 / elapsed))
+
+
+_BENCHMARKS = {
+    "tokenizer": bench_tokenizer,
+    "graph": bench_graph,
+    "cells": bench_cells,
+    "towers": bench_towers,
+}
+
+
+def main(_):
+  if FLAGS.bench not in _BENCHMARKS:
+    raise ValueError("argument \"bench\" is not one of the following: %s."
+                     % ", ".join(sorted(_BENCHMARKS)))
+  _BENCHMARKS[FLAGS.bench]()
+
+
+if __name__ == "__main__":
+  tf.app.run()
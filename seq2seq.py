@@ -44,10 +44,13 @@ one of them, others should be easy to substitute.
     e.g., if you want to write a model that generates captions for images).
   - rnn_decoder: The basic decoder based on a pure RNN.
   - attention_decoder: A decoder that uses the attention mechanism.
+  - dynamic_rnn_decoder: An embedding decoder looping over a time-major tensor.
 
 * Losses.
   - sequence_loss: Loss for a sequence model returning average log-perplexity.
   - sequence_loss_by_example: As above, but not averaging over all examples.
+  - sequence_loss_time_major: sequence_loss over time-major tensors.
+  - fused_sequence_loss: sequence_loss computed on all time steps at once.
 
 * model_with_buckets: A convenience function to create models with bucketing
     (see the tutorial above for an explanation of why and how to use it).
@@ -313,6 +316,88 @@ def embedding_rnn_decoder(decoder_inputs,
                        loop_function=loop_function)
 
 
+def dynamic_rnn_decoder(decoder_inputs,
+                        initial_state,
+                        cell,
+                        embedding,
+                        num_symbols,
+                        embedding_size,
+                        word_dropout_keep_prob=1,
+                        replace_input=None,
+                        output_projection=None,
+                        feed_previous=False,
+                        update_embedding_for_previous=True,
+                        weight_initializer=None,
+                        scope=None):
+  """embedding_rnn_decoder as a loop over a time-major tensor of any length.
+
+  The decoder steps run in a tf.while_loop instead of being unrolled, so the
+  graph does not depend on the number of steps and serves every bucket. The
+  variables are the same as those of embedding_rnn_decoder.
+
+  Args:
+    decoder_inputs: 2D int32 Tensor of shape [max_time, batch_size].
+    initial_state: 2D Tensor [batch_size x cell.state_size].
+    cell: rnn_cell.RNNCell defining the cell function.
+    embedding: the embedding to look inputs up in; created if None.
+    num_symbols: Integer, how many symbols come into the embedding.
+    embedding_size: Integer, the length of the embedding vector for each symbol.
+    word_dropout_keep_prob: with feed_previous, probability of feeding the
+      previous output at a step rather than replace_input.
+    replace_input: 2D Tensor [batch_size x embedding_size] fed at dropped
+      steps.
+    output_projection: as in embedding_rnn_decoder.
+    feed_previous: as in embedding_rnn_decoder.
+    update_embedding_for_previous: as in embedding_rnn_decoder.
+    weight_initializer: initializer factory for a new embedding.
+    scope: VariableScope for the created subgraph; defaults to
+      "embedding_rnn_decoder".
+
+  Returns:
+    A tuple of the form (outputs, state), where:
+      outputs: 3D Tensor [max_time x batch_size x cell.output_size].
+      state: The state of the decoder cell at the final time-step.
+  """
+  with variable_scope.variable_scope(scope or "embedding_rnn_decoder"):
+    if not embedding:
+      embedding = variable_scope.get_variable("embedding", [num_symbols, embedding_size],
+              initializer=weight_initializer())
+    loop_function = _extract_argmax_and_embed(
+        embedding, output_projection,
+        update_embedding_for_previous) if feed_previous else None
+    emb_inp = embedding_ops.embedding_lookup(embedding, decoder_inputs)
+    num_steps = array_ops.shape(decoder_inputs)[0]
+
+    with variable_scope.variable_scope("rnn_decoder"):
+      # The first step creates the variables, as in rnn_decoder.
+      output, state = cell(emb_inp[0], initial_state)
+      variable_scope.get_variable_scope().reuse_variables()
+      inputs_ta = tf.TensorArray(emb_inp.dtype, size=num_steps).unpack(emb_inp)
+      # TensorArray of r0.12 rejects writes whose shape has the same unknown
+      # batch dimension as the first one, so shapes are set after pack().
+      outputs_ta = tf.TensorArray(output.dtype, size=num_steps,
+                                  infer_shape=False).write(0, output)
+
+      def body(time, prev, state, outputs_ta):
+        if loop_function is None:
+          inp = inputs_ta.read(time)
+        elif word_dropout_keep_prob < 1:
+          inp = tf.cond(tf.random_uniform([]) < word_dropout_keep_prob,
+                        lambda: loop_function(prev, time),
+                        lambda: replace_input)
+        else:
+          inp = loop_function(prev, time)
+        output, state = cell(inp, state)
+        return time + 1, output, state, outputs_ta.write(time, output)
+
+      _, _, state, outputs_ta = control_flow_ops.while_loop(
+          lambda time, *_: time < num_steps, body,
+          (tf.constant(1), output, state, outputs_ta))
+    outputs = outputs_ta.pack()
+    outputs.set_shape([None, None, cell.output_size])
+    return outputs, state
+
+
 def embedding_attention_encoder(encoder_inputs,
                                 cell,
                                 num_encoder_symbols,
@@ -410,6 +495,62 @@ def embedding_encoder(encoder_inputs,
     return encoder_state
 
 
+def dynamic_embedding_encoder(encoder_inputs,
+                              sequence_length,
+                              cell,
+                              embedding,
+                              num_symbols,
+                              embedding_size,
+                              bidirectional=False,
+                              dtype=None,
+                              weight_initializer=None,
+                              scope=None):
+  """Embedding encoder running a dynamic RNN over the true sentence lengths.
+
+  Same as embedding_encoder, with the same variables, but the inputs are one
+  batch-major tensor and the RNN is a loop rather than unrolled per time
+  step: steps past an example's sequence_length are not computed and its
+  state is the one at its last real step. The graph does not depend on the
+  input length, so one encoder serves every bucket.
+
+  Args:
+    encoder_inputs: 2D int32 Tensor of shape [batch_size, max_time], each
+      row holding a sentence from position 0, padded at the end.
+    sequence_length: 1D int32 Tensor of shape [batch_size]; the length of
+      each sentence.
+    cell: rnn_cell.RNNCell defining the cell function and size.
+    embedding: the embedding to look inputs up in; created if None.
+    num_symbols: Integer; number of symbols on the encoder side.
+    embedding_size: Integer, the length of the embedding vector for each symbol.
+    bidirectional: Boolean; whether to encode in both directions and
+      concatenate both final states.
+    dtype: The dtype of the initial RNN state (default: tf.float32).
+    weight_initializer: initializer factory for a new embedding.
+    scope: VariableScope for the created subgraph; defaults to
+      "embedding_encoder".
+
+  Returns:
+    The final encoder state, as embedding_encoder.
+  """
+  with variable_scope.variable_scope(
+      scope or "embedding_encoder", dtype=dtype) as scope:
+    dtype = scope.dtype
+    # Encoder.
+    if not embedding:
+      embedding = variable_scope.get_variable("embedding", [num_symbols, embedding_size],
+              initializer=weight_initializer())
+    emb_inp = embedding_ops.embedding_lookup(embedding, encoder_inputs)
+    if bidirectional:
+      _, (output_state_fw, output_state_bw) = rnn.bidirectional_dynamic_rnn(
+          cell, cell, emb_inp, sequence_length=sequence_length, dtype=dtype)
+      encoder_state = tf.concat(1, [output_state_fw, output_state_bw])
+    else:
+      _, encoder_state = rnn.dynamic_rnn(
+          cell, emb_inp, sequence_length=sequence_length, dtype=dtype)
+
+    return encoder_state
+
+
 def sequence_loss_by_example(logits, targets, weights,
                              average_across_timesteps=True,
                              softmax_loss_function=None, name=None):
@@ -456,6 +597,96 @@ def sequence_loss_by_example(logits, targets, weights,
   return log_perps
 
 
+def sequence_loss_time_major(logits, targets, weights,
+                             softmax_loss_function=None, name=None):
+  """sequence_loss over time-major tensors instead of lists of time steps.
+
+  All steps of all examples go through the (sampled) softmax at once, and
+  padded positions are masked out by their zero weight.
+
+  Args:
+    logits: 3D Tensor [max_time x batch_size x num_decoder_symbols], or of
+      any statically known last dimension that softmax_loss_function takes.
+    targets: 2D int32 Tensor [max_time x batch_size].
+    weights: 2D float Tensor [max_time x batch_size].
+    softmax_loss_function: Function (inputs-batch, labels-batch) -> loss-batch
+      to be used instead of the standard softmax (the default if this is None).
+    name: Optional name for this operation, defaults to
+      "sequence_loss_time_major".
+
+  Returns:
+    A scalar float Tensor: The average log-perplexity per symbol (weighted).
+  """
+  with ops.name_scope(name, "sequence_loss_time_major",
+                      [logits, targets, weights]):
+    flat_logits = array_ops.reshape(logits, [-1, logits.get_shape()[2].value])
+    flat_targets = array_ops.reshape(targets, [-1])
+    if softmax_loss_function is None:
+      crossent = nn_ops.sparse_softmax_cross_entropy_with_logits(
+          flat_logits, flat_targets)
+    else:
+      crossent = softmax_loss_function(flat_logits, flat_targets)
+    crossent = array_ops.reshape(crossent, array_ops.shape(targets)) * weights
+    total_size = math_ops.reduce_sum(weights, 0)
+    total_size += 1e-12  # Just to avoid division by 0 for all-0 weights.
+    log_perps = math_ops.reduce_sum(crossent, 0) / total_size
+    batch_size = array_ops.shape(targets)[1]
+    return math_ops.reduce_sum(log_perps) / math_ops.cast(batch_size,
+                                                          log_perps.dtype)
+
+
+def fused_sequence_loss(logits, targets, weights,
+                        softmax_loss_function=None, name=None):
+  """sequence_loss computed on all time steps at once.
+
+  Same as sequence_loss with the default averaging, but the steps are
+  stacked into one [time * batch_size] batch, so the (sampled) softmax runs
+  once over large matrices instead of once per step. Sampled softmax then
+  shares its sampled classes across the steps of a batch.
+
+  Args:
+    logits: List of 2D Tensors of shape [batch_size x num_decoder_symbols],
+      or of the input size of softmax_loss_function.
+    targets: List of 1D batch-sized int32 Tensors of the same length as logits.
+    weights: List of 1D batch-sized float-Tensors of the same length as logits.
+    softmax_loss_function: Function (inputs-batch, labels-batch) -> loss-batch
+      to be used instead of the standard softmax (the default if this is None).
+    name: Optional name for this operation, defaults to "fused_sequence_loss".
+
+  Returns:
+    A scalar float Tensor: The average log-perplexity per symbol (weighted).
+
+  Raises:
+    ValueError: If len(logits) is different from len(targets) or len(weights).
+  """
+  if len(targets) != len(logits) or len(weights) != len(logits):
+    raise ValueError("Lengths of logits, weights, and targets must be the same "
+                     "%d, %d, %d." % (len(logits), len(weights), len(targets)))
+  with ops.name_scope(name, "fused_sequence_loss", logits + targets + weights):
+    return sequence_loss_time_major(
+        array_ops.pack(logits), array_ops.pack(targets),
+        array_ops.pack(weights), softmax_loss_function=softmax_loss_function)
+
+
+def fused_output_projection(outputs, output_projection, name=None):
+  """Projects a list of per-step outputs with a single matmul.
+
+  Args:
+    outputs: List of 2D Tensors [batch_size x output_size].
+    output_projection: a pair (W, B) of output projection weights and biases.
+    name: Optional name for this operation, defaults to
+      "fused_output_projection".
+
+  Returns:
+    List of 2D Tensors [batch_size x num_symbols], one per output.
+  """
+  with ops.name_scope(name, "fused_output_projection", outputs):
+    weights, biases = output_projection
+    stacked = array_ops.concat(0, outputs)
+    logits = nn_ops.xw_plus_b(stacked, weights, biases)
+    return array_ops.split(0, len(outputs), logits)
+
+
 def sequence_loss(logits, targets, weights,
                   average_across_timesteps=True, average_across_batch=True,
                   softmax_loss_function=None, name=None):
@@ -846,9 +1077,13 @@ def variational_decoder_with_buckets(means, logvars, decoder_inputs,
                        targets, weights,
                        buckets, decoder, latent_dec, sample,
                        softmax_loss_function=None,
-                       per_example_loss=False, name=None):
+                       per_example_loss=False, fused_loss=False, name=None):
   """Create a sequence-to-sequence model with support for bucketing.
+
+  With fused_loss, the loss of each bucket is a fused_sequence_loss.
   """
+  if fused_loss and per_example_loss:
+    raise ValueError("fused_loss does not support per_example_loss.")
   if len(targets) < buckets[-1][1]:
     raise ValueError("Length of targets (%d) must be at least that of last"
                      "bucket (%d)." % (len(targets), buckets[-1][1]))
@@ -875,7 +1110,11 @@ def variational_decoder_with_buckets(means, logvars, decoder_inputs,
         total_size += 1e-12
         KL_objs.append(tf.reduce_mean(kl_obj / total_size))
         KL_costs.append(tf.reduce_mean(kl_cost / total_size))
-        if per_example_loss:
+        if fused_loss:
+          losses.append(fused_sequence_loss(
+              outputs[-1], targets[:bucket[1]], weights[:bucket[1]],
+              softmax_loss_function=softmax_loss_function))
+        elif per_example_loss:
           losses.append(sequence_loss_by_example(
               outputs[-1], targets[:bucket[1]], weights[:bucket[1]],
               softmax_loss_function=softmax_loss_function))
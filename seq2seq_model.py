@@ -19,7 +19,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import random
+import collections
+import contextlib
+import itertools
+import json
 
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
@@ -27,8 +30,42 @@ import tensorflow as tf
 
 import utils.data_utils as data_utils
 import seq2seq
+from tensorflow.python.framework import graph_util
 from tensorflow.python.ops import variable_scope
 
+try:
+  from tensorflow.tools.graph_transforms import TransformGraph
+except ImportError:  # Not available in every TensorFlow release.
+  TransformGraph = None
+
+# The default cells and the fused block cells that hold the same weights in
+# the same layout, so checkpoints of either backend can be restored into the
+# other; see _cell_variable_renames.
+_CELL_PAIRS = [
+    (lambda size: tf.nn.rnn_cell.GRUCell(size),
+     lambda size: tf.contrib.rnn.GRUBlockCell(size)),
+    (lambda size: tf.nn.rnn_cell.BasicLSTMCell(size),
+     lambda size: tf.contrib.rnn.LSTMBlockCell(size)),
+]
+_cell_renames = None
+
+_CELL_BACKENDS = ["default", "block"]
+
+# Keys of Seq2SeqModel.inference_signature() that name input placeholders,
+# and those that name tensors inference fetches or feeds in their stead.
+_SIGNATURE_INPUTS = ["encoder_inputs", "encoder_input_ids", "encoder_lengths",
+                     "decoder_inputs", "target_weights", "decoder_input_ids",
+                     "target_weight_values", "replace_input"]
+_SIGNATURE_OUTPUTS = ["means", "logvars", "outputs", "output_logits"]
+# Keys of a signature that hold settings rather than names.
+_SIGNATURE_SETTINGS = ["buckets", "latent_dim", "word_dropout_keep_prob",
+                       "dynamic_encoder", "single_graph", "batch_size",
+                       "num_towers", "accumulate_steps"]
+
+# The part of the model built on the batch slice of one tower.
+_Tower = collections.namedtuple(
+    "_Tower", ["means", "logvars", "outputs", "losses", "KL_objs", "KL_costs"])
+
 class Seq2SeqModel(object):
   """Sequence-to-sequence model with attention and for multiple buckets.
 
@@ -68,6 +105,12 @@ class Seq2SeqModel(object):
                weight_initializer=None,
                bias_initializer=None,
                iaf=False,
+               dynamic_encoder=False,
+               single_graph=False,
+               fused_loss=False,
+               cell_backend="default",
+               num_towers=1,
+               accumulate_steps=1,
                dtype=tf.float32):
     """Create the model.
 
@@ -89,6 +132,29 @@ class Seq2SeqModel(object):
       use_lstm: if true, we use LSTM cells instead of GRU cells.
       num_samples: number of samples for sampled softmax.
       forward_only: if set, we do not construct the backward pass in the model.
+      dynamic_encoder: if set, one dynamic RNN encoder over the true sentence
+        lengths is shared by all buckets instead of a static one per bucket.
+      single_graph: if set, one graph over inputs of any length serves all
+        buckets: the dynamic encoder, a tf.while_loop decoder, one loss and
+        one update op. Implies dynamic_encoder.
+      fused_loss: if set, the output projection and the loss of each bucket
+        are computed on all its time steps at once rather than per step; the
+        single graph always does so.
+      cell_backend: "default" for the GRUCell or BasicLSTMCell of
+        tf.nn.rnn_cell, "block" for the GRUBlockCell or LSTMBlockCell of
+        tf.contrib.rnn, which run each step as one fused kernel.
+      num_towers: number of towers the batches are split across for training,
+        each on its own CPU device /cpu:k; their clipped gradients are
+        averaged into one update. The session needs that many CPU devices,
+        and batch_size must be a multiple of num_towers. The devices share
+        the process's intra-op thread pool, so towers split the graph, not
+        the threads.
+      accumulate_steps: if greater than 1, the update op of a bucket only
+        adds the clipped gradients of a batch to accumulator variables, and
+        apply_accumulated applies their average over accumulate_steps
+        batches and resets them. The accumulators are local variables, so
+        they are not saved; run accumulator_init after initializing or
+        restoring the model.
       dtype: the data type to use to store internal variables.
     """
     self.source_vocab_size = source_vocab_size
@@ -98,6 +164,12 @@ class Seq2SeqModel(object):
     self.batch_size = batch_size
     self.word_dropout_keep_prob = word_dropout_keep_prob
     self.kl_min = kl_min
+    self.single_graph = single_graph
+    self.num_towers = 1 if forward_only else num_towers
+    if batch_size % self.num_towers:
+      raise ValueError("batch_size (%d) must be a multiple of num_towers (%d)."
+                       % (batch_size, self.num_towers))
+    self.dynamic_encoder = dynamic_encoder = dynamic_encoder or single_graph
     feed_previous = feed_previous or forward_only
 
     self.learning_rate = tf.Variable(
@@ -140,9 +212,17 @@ class Seq2SeqModel(object):
             dtype)
       softmax_loss_function = sampled_loss
     # Create the internal multi-layer cell for our RNN.
-    single_cell = tf.nn.rnn_cell.GRUCell(size)
-    if use_lstm:
-      single_cell = tf.nn.rnn_cell.BasicLSTMCell(size)
+    if cell_backend not in _CELL_BACKENDS:
+      raise ValueError("cell_backend must be one of %s, not %r."
+                       % (", ".join(_CELL_BACKENDS), cell_backend))
+    if cell_backend == "block":
+      single_cell = tf.contrib.rnn.GRUBlockCell(size)
+      if use_lstm:
+        single_cell = tf.contrib.rnn.LSTMBlockCell(size)
+    else:
+      single_cell = tf.nn.rnn_cell.GRUCell(size)
+      if use_lstm:
+        single_cell = tf.nn.rnn_cell.BasicLSTMCell(size)
 
     cell = single_cell
 
@@ -157,7 +237,7 @@ class Seq2SeqModel(object):
           weight_initializer=weight_initializer,
           dtype=dtype)
 
-    def decoder_f(encoder_state, decoder_inputs):
+    def decoder_f(encoder_state, decoder_inputs, replace_input):
       return seq2seq.embedding_rnn_decoder(
           decoder_inputs,
           encoder_state,
@@ -171,6 +251,20 @@ class Seq2SeqModel(object):
           feed_previous=feed_previous,
           weight_initializer=weight_initializer)
 
+    def dynamic_decoder_f(encoder_state, decoder_inputs, replace_input):
+      return seq2seq.dynamic_rnn_decoder(
+          decoder_inputs,
+          encoder_state,
+          cell,
+          embedding=self.dec_embedding,
+          word_dropout_keep_prob=word_dropout_keep_prob,
+          replace_input=replace_input,
+          num_symbols=target_vocab_size,
+          embedding_size=size,
+          output_projection=output_projection,
+          feed_previous=feed_previous,
+          weight_initializer=weight_initializer)
+
     def enc_latent_f(encoder_state):
       return seq2seq.encoder_to_latent(
                      encoder_state,
@@ -203,6 +297,18 @@ class Seq2SeqModel(object):
            self.kl_rate,
            dtype)
 
+    def dynamic_encoder_f(encoder_inputs, sequence_length):
+      return seq2seq.dynamic_embedding_encoder(
+          encoder_inputs,
+          sequence_length,
+          cell,
+          self.enc_embedding,
+          num_symbols=source_vocab_size,
+          embedding_size=size,
+          bidirectional=bidirectional,
+          weight_initializer=weight_initializer,
+          dtype=dtype)
+
     # The seq2seq function: we use embedding for the input and attention.
     def seq2seq_f(encoder_inputs, decoder_inputs, do_decode):
       return tf.nn.seq2seq.embedding_attention_seq2seq_f(
@@ -221,54 +327,209 @@ class Seq2SeqModel(object):
     self.encoder_inputs = []
     self.decoder_inputs = []
     self.target_weights = []
-    for i in xrange(buckets[-1][0]):  # Last bucket is the biggest one.
+    for i in xrange(0 if dynamic_encoder else buckets[-1][0]):  # Last bucket is the biggest one.
       self.encoder_inputs.append(tf.placeholder(tf.int32, shape=[None],
                                                 name="encoder{0}".format(i)))
-    for i in xrange(buckets[-1][1] + 1):
+    for i in xrange(0 if single_graph else buckets[-1][1] + 1):
       self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None],
                                                 name="decoder{0}".format(i)))
       self.target_weights.append(tf.placeholder(dtype, shape=[None],
                                                 name="weight{0}".format(i)))
 
-    # Our targets are decoder inputs shifted by one.
-    targets = [self.decoder_inputs[i + 1]
-               for i in xrange(len(self.decoder_inputs) - 1)]
-
-
-    self.means, self.logvars = seq2seq.variational_encoder_with_buckets(
-        self.encoder_inputs, buckets, encoder_f, enc_latent_f,
-        softmax_loss_function=softmax_loss_function)
-    self.outputs, self.losses, self.KL_objs, self.KL_costs = seq2seq.variational_decoder_with_buckets(
-        self.means, self.logvars, self.decoder_inputs, targets,
-        self.target_weights, buckets, decoder_f, latent_dec_f,
-        sample_f, softmax_loss_function=softmax_loss_function)
-
-    # If we use output projection, we need to project outputs for decoding.
-    if output_projection is not None:
-      for b in xrange(len(buckets)):
-        self.outputs[b] = [
-            tf.matmul(output, output_projection[0]) + output_projection[1]
-            for output in self.outputs[b]
-          ]
-    # Gradients and SGD update operation for training the model.
+    self.encoder_input_ids = self.encoder_lengths = None
+    self.decoder_input_ids = self.target_weight_values = None
+    if dynamic_encoder:
+      # Sentences in [batch, time] layout, see _dynamic_encoder_feed.
+      self.encoder_input_ids = tf.placeholder(tf.int32, shape=[None, None],
+                                              name="encoder_input_ids")
+      self.encoder_lengths = tf.placeholder(tf.int32, shape=[None],
+                                            name="encoder_lengths")
+    if single_graph:
+      # Time-major [time, batch] inputs and weights, as made by make_batch.
+      self.decoder_input_ids = tf.placeholder(tf.int32, shape=[None, None],
+                                              name="decoder_input_ids")
+      self.target_weight_values = tf.placeholder(
+          dtype, shape=[None, None], name="target_weight_values")
+
+    def forward(encoder_inputs, encoder_input_ids, encoder_lengths,
+                decoder_inputs, target_weights, decoder_input_ids,
+                target_weight_values, replace_input):
+      """Builds the model on one batch of inputs; returns a _Tower."""
+      if dynamic_encoder:
+        with tf.name_scope("dynamic_encoder"):
+          mean, logvar = enc_latent_f(dynamic_encoder_f(encoder_input_ids,
+                                                        encoder_lengths))
+        means = [mean] * len(buckets)
+        logvars = [logvar] * len(buckets)
+      else:
+        means, logvars = seq2seq.variational_encoder_with_buckets(
+            encoder_inputs, buckets, encoder_f, enc_latent_f,
+            softmax_loss_function=softmax_loss_function)
+
+      if single_graph:
+        with tf.name_scope("single_graph"):
+          targets = tf.concat(0, [decoder_input_ids[1:],
+                                  tf.zeros_like(decoder_input_ids[:1])])
+          latent_vector, kl_obj, kl_cost = sample_f(means[0], logvars[0])
+          outputs, _ = dynamic_decoder_f(latent_dec_f(latent_vector),
+                                         decoder_input_ids, replace_input)
+          total_size = tf.reduce_sum(target_weight_values, 0) + 1e-12
+          loss = seq2seq.sequence_loss_time_major(
+              outputs, targets, target_weight_values,
+              softmax_loss_function=softmax_loss_function)
+          # Output logits of all steps, [time, batch, target_vocab_size].
+          if output_projection is not None:
+            outputs = tf.reshape(
+                tf.matmul(tf.reshape(outputs, [-1, size]), output_projection[0])
+                + output_projection[1],
+                tf.concat(0, [tf.shape(outputs)[:2], [target_vocab_size]]))
+        return _Tower(means, logvars, outputs, [loss] * len(buckets),
+                      [tf.reduce_mean(kl_obj / total_size)] * len(buckets),
+                      [tf.reduce_mean(kl_cost / total_size)] * len(buckets))
+
+      # Our targets are decoder inputs shifted by one.
+      targets = [decoder_inputs[i + 1]
+                 for i in xrange(len(decoder_inputs) - 1)]
+      outputs, losses, KL_objs, KL_costs = seq2seq.variational_decoder_with_buckets(
+          means, logvars, decoder_inputs, targets,
+          target_weights, buckets,
+          lambda state, inputs: decoder_f(state, inputs, replace_input),
+          latent_dec_f, sample_f, softmax_loss_function=softmax_loss_function,
+          fused_loss=fused_loss)
+
+      # If we use output projection, we need to project outputs for decoding.
+      if output_projection is not None:
+        for b in xrange(len(buckets)):
+          if fused_loss:
+            outputs[b] = seq2seq.fused_output_projection(
+                outputs[b], output_projection)
+            continue
+          outputs[b] = [
+              tf.matmul(output, output_projection[0]) + output_projection[1]
+              for output in outputs[b]
+            ]
+      return _Tower(means, logvars, outputs, losses, KL_objs, KL_costs)
+
+    inputs = [self.encoder_inputs, self.encoder_input_ids, self.encoder_lengths,
+              self.decoder_inputs, self.target_weights, self.decoder_input_ids,
+              self.target_weight_values, replace_input]
+    if self.num_towers == 1:
+      towers = [forward(*inputs)]
+    else:
+      # Every tower gets its slice of the batch; all tower slices of each
+      # input are split off at once.
+      tower_inputs = [[] for _ in xrange(self.num_towers)]
+      for value, axis in zip(inputs, [0, 0, 0, 0, 0, 1, 1, 0]):
+        if value is None:
+          splits = [None] * self.num_towers
+        elif isinstance(value, list):
+          splits = list(zip(*[tf.split(axis, self.num_towers, v)
+                              for v in value])) or [[]] * self.num_towers
+          splits = [list(tower_value) for tower_value in splits]
+        else:
+          splits = tf.split(axis, self.num_towers, value)
+        for tower_input, tower_value in zip(tower_inputs, splits):
+          tower_input.append(tower_value)
+      towers = []
+      for k in xrange(self.num_towers):
+        with _tower_scope(k, self.num_towers):
+          with variable_scope.variable_scope(variable_scope.get_variable_scope(),
+                                             reuse=True if k > 0 else None):
+            towers.append(forward(*tower_inputs[k]))
+    self._towers = towers
+
+    # The whole batch is the concatenation of the tower slices.
+    self.means, self.logvars, self.outputs = _concat_towers(
+        towers, single_graph)
+    self.output_logits = self.outputs if single_graph else None
+    if single_graph:
+      self.outputs = None
+    self.losses, self.KL_objs, self.KL_costs = [
+        [tf.add_n(tower_values) / len(towers)
+         if len(towers) > 1 else tower_values[0]
+         for tower_values in zip(*[getattr(tower, name) for tower in towers])]
+        for name in ("losses", "KL_objs", "KL_costs")]
+
+    # Gradients and SGD update operation for training the model. Every tower
+    # clips its own gradients, and the update applies their average.
     params = tf.trainable_variables()
+    self.gradient_norms = self.updates = None
+    self.accumulate_steps = accumulate_steps
+    self.accumulator_init = self.apply_accumulated = None
     if not forward_only:
       self.gradient_norms = []
       self.updates = []
-      for b in xrange(len(buckets)):
-        total_loss = self.losses[b] + self.KL_objs[b]
-        gradients = tf.gradients(total_loss, params)
-        clipped_gradients, norm = tf.clip_by_global_norm(gradients,
-                                                         max_gradient_norm)
+      if accumulate_steps > 1:
+        accumulators = [
+            tf.Variable(tf.zeros(param.get_shape(), dtype=param.dtype.base_dtype),
+                        trainable=False, name=param.op.name + "/accumulator",
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            for param in params]
+      # A single graph has the same loss, and so the same update, for every
+      # bucket.
+      for b in xrange(1 if single_graph else len(buckets)):
+        tower_gradients = []
+        tower_norms = []
+        for k, tower in enumerate(towers):
+          with _tower_scope(k, len(towers)):
+            total_loss = tower.losses[b] + tower.KL_objs[b]
+            gradients = tf.gradients(total_loss, params)
+            clipped_gradients, norm = tf.clip_by_global_norm(gradients,
+                                                             max_gradient_norm)
+          tower_gradients.append(clipped_gradients)
+          tower_norms.append(norm)
+        clipped_gradients = _average_gradients(tower_gradients)
+        norm = (tf.add_n(tower_norms) / len(towers)
+                if len(towers) > 1 else tower_norms[0])
         self.gradient_norms.append(norm)
-        self.updates.append(optimizer.apply_gradients(
-            zip(clipped_gradients, params), global_step=self.global_step))
+        if accumulate_steps > 1:
+          self.updates.append(_accumulate(accumulators, clipped_gradients))
+        else:
+          self.updates.append(optimizer.apply_gradients(
+              zip(clipped_gradients, params), global_step=self.global_step))
+      if single_graph:
+        self.gradient_norms *= len(buckets)
+        self.updates *= len(buckets)
+      if accumulate_steps > 1:
+        # One update from the accumulated gradients of all buckets.
+        self.accumulator_init = tf.variables_initializer(accumulators)
+        update = optimizer.apply_gradients(
+            [(accumulator / accumulate_steps, param)
+             for accumulator, param in zip(accumulators, params)],
+            global_step=self.global_step)
+        with tf.control_dependencies([update]):
+          self.apply_accumulated = tf.group(
+              *[accumulator.assign(tf.zeros_like(accumulator))
+                for accumulator in accumulators])
 
     self.saver = tf.train.Saver(tf.global_variables())
 
 
+  def restore(self, session, checkpoint_path):
+    """Restores the variables from a checkpoint, made with any cell backend.
+
+    Cell variables the checkpoint holds under the name of the other backend
+    (see _cell_variable_renames) are restored from that name.
+    """
+    checkpoint_names = tf.train.NewCheckpointReader(
+        checkpoint_path).get_variable_to_shape_map()
+    var_list = {}
+    for variable in tf.global_variables():
+      name = variable.op.name
+      if name not in checkpoint_names:
+        for default_name, block_name in _cell_variable_renames():
+          for old, new in ((default_name, block_name),
+                           (block_name, default_name)):
+            if old in name and name.replace(old, new) in checkpoint_names:
+              name = name.replace(old, new)
+      var_list[name] = variable
+    if all(name == variable.op.name for name, variable in var_list.items()):
+      self.saver.restore(session, checkpoint_path)
+    else:
+      tf.train.Saver(var_list).restore(session, checkpoint_path)
+
   def step(self, session, encoder_inputs, decoder_inputs, target_weights,
-             bucket_id, forward_only, prob, beam_size=1):
+             bucket_id, forward_only, prob, beam_size=1, run_metadata=None):
     """Run a step of the model feeding the given inputs.
   
     Args:
@@ -278,6 +539,8 @@ class Seq2SeqModel(object):
       target_weights: list of numpy float vectors to feed as target weights.
       bucket_id: which bucket of the model to use.
       forward_only: whether to do the backward step or only forward.
+      run_metadata: if given, a tf.RunMetadata the step is traced into,
+        see tower_times.
   
     Returns:
       A triple consisting of gradient norm (or None if we did not do backward),
@@ -287,6 +550,35 @@ class Seq2SeqModel(object):
       ValueError: if length of encoder_inputs, decoder_inputs, or
         target_weights disagrees with bucket size for the specified bucket_id.
     """
+    input_feed = self._step_feed(encoder_inputs, decoder_inputs,
+                                 target_weights, bucket_id, prob)
+
+    # Output feed: depends on whether we do a backward step or not.
+    if not forward_only:
+      output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
+                     self.gradient_norms[bucket_id],  # Gradient norm.
+                     self.losses[bucket_id],
+                     self.KL_costs[bucket_id]]  # Loss for this batch.
+    else:
+      output_feed = [self.losses[bucket_id], self.KL_costs[bucket_id]]  # Loss for this batch.
+      output_feed.extend(self._output_logits_feed(bucket_id))
+  
+    if run_metadata is None:
+      outputs = session.run(output_feed, input_feed)
+    else:
+      outputs = session.run(
+          output_feed, input_feed,
+          options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+          run_metadata=run_metadata)
+    if not forward_only:
+      return outputs[1], outputs[2], outputs[3], None  # Gradient norm, loss, KL divergence, no outputs.
+    else:
+      return None, outputs[0], outputs[1], self._output_logits(outputs[2:])  # no gradient norm, loss, KL divergence, outputs.
+
+
+  def _step_feed(self, encoder_inputs, decoder_inputs, target_weights,
+                 bucket_id, prob):
+    """Input feed of step(); raises ValueError if the sizes do not match."""
     # Check if the sizes match.
     encoder_size, decoder_size = self.buckets[bucket_id]
     if len(encoder_inputs) != encoder_size:
@@ -300,38 +592,144 @@ class Seq2SeqModel(object):
                        " %d != %d." % (len(target_weights), decoder_size))
   
     # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
-    input_feed = {}
-    for l in xrange(encoder_size):
-      input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
-    for l in xrange(decoder_size):
-      input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
-      input_feed[self.target_weights[l].name] = target_weights[l]
+    input_feed = self._encoder_feed(encoder_inputs)
+    input_feed.update(self._decoder_feed(decoder_inputs, target_weights))
     if self.word_dropout_keep_prob < 1:
       input_feed[self.replace_input.name] = np.full((self.batch_size), data_utils.UNK_ID, dtype=np.int32)
-  
-    # Since our targets are decoder inputs shifted by one, we need one more.
-    last_target = self.decoder_inputs[decoder_size].name
-    input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
     if not prob:
-      input_feed[self.logvars[bucket_id]] = np.full((self.batch_size, self.latent_dim), -800.0, dtype=np.float32)
-  
-    # Output feed: depends on whether we do a backward step or not.
-    if not forward_only:
-      output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
-                     self.gradient_norms[bucket_id],  # Gradient norm.
-                     self.losses[bucket_id],
-                     self.KL_costs[bucket_id]]  # Loss for this batch.
-    else:
-      output_feed = [self.losses[bucket_id], self.KL_costs[bucket_id]]  # Loss for this batch.
-      for l in xrange(decoder_size):  # Output logits.
-        output_feed.append(self.outputs[bucket_id][l])
-  
-    outputs = session.run(output_feed, input_feed)
-    if not forward_only:
-      return outputs[1], outputs[2], outputs[3], None  # Gradient norm, loss, KL divergence, no outputs.
-    else:
-      return None, outputs[0], outputs[1], outputs[2:]  # no gradient norm, loss, KL divergence, outputs.
+      for tower in self._towers:
+        input_feed[tower.logvars[bucket_id]] = np.full((self.batch_size // len(self._towers), self.latent_dim), -800.0, dtype=np.float32)
+    return input_feed
+
+  def inference_signature(self):
+    """Names of the tensors inference feeds and fetches, for FrozenModel.
+
+    Returns:
+      A dict with the settings the feeds depend on, the names of the input
+      placeholders (None for those the model does not have), and the names
+      of the means, logvars and output logits of every bucket.
+    """
+    def names(tensors):
+      return None if tensors is None else [t.name for t in tensors]
+
+    def name(tensor):
+      return None if tensor is None else tensor.name
 
+    return {
+        "buckets": [list(bucket) for bucket in self.buckets],
+        "latent_dim": self.latent_dim,
+        "word_dropout_keep_prob": self.word_dropout_keep_prob,
+        "dynamic_encoder": self.dynamic_encoder,
+        "single_graph": self.single_graph,
+        "encoder_inputs": names(self.encoder_inputs),
+        "encoder_input_ids": name(self.encoder_input_ids),
+        "encoder_lengths": name(self.encoder_lengths),
+        "decoder_inputs": names(self.decoder_inputs),
+        "target_weights": names(self.target_weights),
+        "decoder_input_ids": name(self.decoder_input_ids),
+        "target_weight_values": name(self.target_weight_values),
+        "replace_input": name(self.replace_input),
+        "means": names(self.means),
+        "logvars": names(self.logvars),
+        "outputs": None if self.single_graph else [
+            names(self._output_logits_feed(b))
+            for b in xrange(len(self.buckets))],
+        "output_logits": name(self.output_logits),
+    }
+
+  def graph_signature(self):
+    """Names of all the tensors and ops the model exposes, see from_meta_graph.
+
+    Returns:
+      The inference_signature(), with the batch size and number of towers,
+      and the names of the variables, losses and update ops for training.
+    """
+    def names(values):
+      return None if values is None else [value.name for value in values]
+
+    def name(value):
+      return None if value is None else value.name
+
+    signature = self.inference_signature()
+    signature.update({
+        "batch_size": self.batch_size,
+        "num_towers": self.num_towers,
+        "accumulate_steps": self.accumulate_steps,
+        "learning_rate": self.learning_rate.name,
+        "global_step": self.global_step.name,
+        "kl_rate": self.kl_rate.name,
+        "new_kl_rate": self.new_kl_rate.name,
+        "kl_rate_update": self.kl_rate_update.name,
+        "losses": names(self.losses),
+        "KL_objs": names(self.KL_objs),
+        "KL_costs": names(self.KL_costs),
+        "gradient_norms": names(self.gradient_norms),
+        "updates": names(self.updates),
+        "accumulator_init": name(self.accumulator_init),
+        "apply_accumulated": name(self.apply_accumulated),
+        "tower_logvars": [names(tower.logvars) for tower in self._towers],
+    })
+    return signature
+
+  def export_meta_graph(self, meta_graph_path):
+    """Write the graph for from_meta_graph, with its signature as .json."""
+    self.saver.export_meta_graph(meta_graph_path)
+    with tf.gfile.GFile(meta_graph_path + ".json", mode="w") as signature_file:
+      json.dump(self.graph_signature(), signature_file, indent=2)
+
+  @classmethod
+  def from_meta_graph(cls, meta_graph_path):
+    """Import a graph written by export_meta_graph into the default graph.
+
+    This skips building the graph in Python: the model is bound to the
+    imported tensors and ops, and its saver is the one the graph was
+    exported with.
+    """
+    with tf.gfile.GFile(meta_graph_path + ".json", mode="r") as signature_file:
+      signature = json.load(signature_file)
+    model = object.__new__(cls)
+    model.saver = tf.train.import_meta_graph(meta_graph_path)
+    model._bind(tf.get_default_graph(), signature)
+    return model
+
+  def _bind(self, graph, signature):
+    """Set the attributes named in signature to the elements of graph."""
+    def lookup(value):
+      if value is None:
+        return None
+      if isinstance(value, list):
+        return [lookup(v) for v in value]
+      return graph.as_graph_element(value)
+
+    for key, value in signature.items():
+      if key == "buckets":
+        self.buckets = [tuple(bucket) for bucket in value]
+      elif key in _SIGNATURE_SETTINGS:
+        setattr(self, key, value)
+      elif key != "tower_logvars":
+        setattr(self, key, lookup(value))
+    # Only the logvars of the towers are fed separately.
+    self._towers = [_Tower(None, logvars, None, None, None, None) for logvars
+                    in lookup(signature.get("tower_logvars",
+                                            [signature["logvars"]]))]
+
+  def tower_times(self, run_metadata):
+    """Seconds every tower's device was busy in a step traced by step().
+
+    Returns:
+      A list with the time from the first op started to the last op finished
+      on /cpu:k for every tower k.
+    """
+    spans = [None] * self.num_towers
+    for device_stats in run_metadata.step_stats.dev_stats:
+      device = device_stats.device.lower()
+      for k in xrange(self.num_towers):
+        if device.endswith("cpu:%d" % k) and device_stats.node_stats:
+          start = min(node.all_start_micros for node in device_stats.node_stats)
+          end = max(node.all_start_micros + node.all_end_rel_micros
+                    for node in device_stats.node_stats)
+          spans[k] = (end - start) / 1e6
+    return spans
 
   def encode_to_latent(self, session, encoder_inputs, bucket_id):
 
@@ -341,11 +739,7 @@ class Seq2SeqModel(object):
       raise ValueError("Encoder length must be equal to the one in bucket,"
                        " %d != %d." % (len(encoder_inputs), encoder_size))
 
-    input_feed = {}
-    for l in xrange(encoder_size):
-      input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
-
-
+    input_feed = self._encoder_feed(encoder_inputs)
     output_feed = [self.means[bucket_id], self.logvars[bucket_id]]
     means, logvars = session.run(output_feed, input_feed)
 
@@ -354,28 +748,54 @@ class Seq2SeqModel(object):
 
   def decode_from_latent(self, session, means, logvars, bucket_id, decoder_inputs, target_weights):
 
-    _, decoder_size = self.buckets[bucket_id]
     # Input feed: means.
     input_feed = {self.means[bucket_id]: means}
     input_feed[self.logvars[bucket_id]] = logvars
 
-    for l in xrange(decoder_size):
-      input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
-      input_feed[self.target_weights[l].name] = target_weights[l]
+    input_feed.update(self._decoder_feed(decoder_inputs, target_weights))
     if self.word_dropout_keep_prob < 1:
       input_feed[self.replace_input.name] = np.full((self.batch_size), data_utils.UNK_ID, dtype=np.int32)
 
+    outputs = session.run(self._output_logits_feed(bucket_id), input_feed)
+
+    return self._output_logits(outputs)
+
+  def _encoder_feed(self, encoder_inputs):
+    """Feed dict of the time-major, reversed and left-padded encoder inputs."""
+    if not self.dynamic_encoder:
+      return dict((self.encoder_inputs[l].name, encoder_inputs[l])
+                  for l in xrange(len(encoder_inputs)))
+    encoder_input_ids, encoder_lengths = _dynamic_encoder_feed(encoder_inputs)
+    return {self.encoder_input_ids.name: encoder_input_ids,
+            self.encoder_lengths.name: encoder_lengths}
+
+  def _decoder_feed(self, decoder_inputs, target_weights):
+    """Feed dict of the time-major decoder inputs and target weights."""
+    if self.single_graph:
+      return {self.decoder_input_ids.name: np.asarray(decoder_inputs),
+              self.target_weight_values.name: np.asarray(target_weights)}
+    decoder_size = len(decoder_inputs)
+    input_feed = {}
+    for l in xrange(decoder_size):
+      input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
+      input_feed[self.target_weights[l].name] = target_weights[l]
+    # Since our targets are decoder inputs shifted by one, we need one more.
     last_target = self.decoder_inputs[decoder_size].name
-    input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
-    output_feed = []
-    for l in xrange(decoder_size):  # Output logits.
-      output_feed.append(self.outputs[bucket_id][l])
+    input_feed[last_target] = np.zeros([len(decoder_inputs[0])], dtype=np.int32)
+    return input_feed
 
-    outputs = session.run(output_feed, input_feed)
+  def _output_logits_feed(self, bucket_id):
+    if self.single_graph:
+      return [self.output_logits]
+    return self.outputs[bucket_id][:self.buckets[bucket_id][1]]
 
-    return outputs
+  def _output_logits(self, fetched):
+    """The list of per-step output logits from fetched _output_logits_feed."""
+    if self.single_graph:
+      return list(fetched[0])
+    return fetched
 
-  def get_batch(self, data, bucket_id):
+  def get_batch(self, data, bucket_id, example_ids=None):
     """Get a random batch of data from the specified bucket, prepare for step.
 
     To feed data in step(..) it must be a list of batch-major vectors, while
@@ -386,51 +806,263 @@ class Seq2SeqModel(object):
       data: a tuple of size len(self.buckets) in which each element contains
         lists of pairs of input and output data that we use to create a batch.
       bucket_id: integer, which bucket to get the batch for.
+      example_ids: if given, the indices in data[bucket_id] of the examples
+        to put into the batch instead of batch_size random ones.
 
     Returns:
       The triple (encoder_inputs, decoder_inputs, target_weights) for
       the constructed batch that has the proper format to call step(...) later.
     """
+    bucket = data[bucket_id]
+    if example_ids is None:
+      example_ids = np.random.randint(len(bucket), size=self.batch_size)
+    return self.make_batch([bucket[i] for i in example_ids], bucket_id)
+
+  def make_batch(self, examples, bucket_id):
+    """Prepare the given (source, target) examples for step(...).
+
+    Encoder inputs are padded and then reversed, decoder inputs get an extra
+    "GO" symbol and are padded. Everything is written into preallocated
+    time-major int32 arrays, so the row l of each array is the batch-sized
+    vector fed at time-step l, and target_weights are derived from the
+    shifted decoder inputs with a single comparison.
+
+    Args:
+      examples: a list of (source, target) pairs of token-id sequences.
+      bucket_id: integer, which bucket the batch is prepared for.
+
+    Returns:
+      The triple (encoder_inputs, decoder_inputs, target_weights) of arrays of
+      shape [encoder_size, len(examples)], [decoder_size, len(examples)] and
+      [decoder_size, len(examples)] respectively.
+    """
     encoder_size, decoder_size = self.buckets[bucket_id]
-    encoder_inputs, decoder_inputs = [], []
-
-    # Get a random batch of encoder and decoder inputs from data,
-    # pad them if needed, reverse encoder inputs and add GO to decoder.
-    for _ in xrange(self.batch_size):
-      encoder_input, decoder_input = random.choice(data[bucket_id])
-
-      # Encoder inputs are padded and then reversed.
-      encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
-      encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
-
-      # Decoder inputs get an extra "GO" symbol, and are padded then.
-      decoder_pad_size = decoder_size - len(decoder_input) - 1
-      decoder_inputs.append([data_utils.GO_ID] + decoder_input +
-                            [data_utils.PAD_ID] * decoder_pad_size)
-
-    # Now we create batch-major vectors from the data selected above.
-    batch_encoder_inputs, batch_decoder_inputs, batch_weights = [], [], []
-
-    # Batch encoder inputs are just re-indexed encoder_inputs.
-    for length_idx in xrange(encoder_size):
-      batch_encoder_inputs.append(
-          np.array([encoder_inputs[batch_idx][length_idx]
-                    for batch_idx in xrange(self.batch_size)], dtype=np.int32))
-
-    # Batch decoder inputs are re-indexed decoder_inputs, we create weights.
-    for length_idx in xrange(decoder_size):
-      batch_decoder_inputs.append(
-          np.array([decoder_inputs[batch_idx][length_idx]
-                    for batch_idx in xrange(self.batch_size)], dtype=np.int32))
-
-      # Create target_weights to be 0 for targets that are padding.
-      batch_weight = np.ones(self.batch_size, dtype=np.float32)
-      for batch_idx in xrange(self.batch_size):
-        # We set weight to 0 if the corresponding target is a PAD symbol.
-        # The corresponding target is decoder_input shifted by 1 forward.
-        if length_idx < decoder_size - 1:
-          target = decoder_inputs[batch_idx][length_idx + 1]
-        if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
-          batch_weight[batch_idx] = 0.0
-      batch_weights.append(batch_weight)
+
+    # Sources that are too long keep their last tokens (the ones reversing
+    # puts first), targets that are too long keep their first tokens.
+    sources = _pad_rows([source[-encoder_size:] for source, _ in examples],
+                        encoder_size)
+    batch_encoder_inputs = np.ascontiguousarray(sources[:, ::-1].T)
+
+    batch_decoder_inputs = np.empty([decoder_size, len(examples)],
+                                    dtype=np.int32)
+    batch_decoder_inputs[0] = data_utils.GO_ID
+    batch_decoder_inputs[1:] = _pad_rows(
+        [target[:decoder_size - 1] for _, target in examples],
+        decoder_size - 1).T
+
+    # The target of decoder input l is decoder input l + 1, and we set its
+    # weight to 0 if it is a PAD symbol; the last input has no target.
+    batch_weights = np.zeros([decoder_size, len(examples)], dtype=np.float32)
+    batch_weights[:-1] = batch_decoder_inputs[1:] != data_utils.PAD_ID
     return batch_encoder_inputs, batch_decoder_inputs, batch_weights
+
+
+class FrozenModel(Seq2SeqModel):
+  """A forward-only model loaded from a graph written by export_inference_graph.
+
+  The graph holds only the encoder and the decoder of every bucket, with the
+  variables folded into constants: no losses, KL terms, optimizer slots or
+  saver, so it is imported much faster and in less memory than the model is
+  built and restored. It serves encode_to_latent, decode_from_latent,
+  get_batch, make_batch and forward-only step, whose losses are None.
+  """
+
+  def __init__(self, export_path):
+    """Import the frozen graph at export_path into the default graph."""
+    with tf.gfile.GFile(export_path + ".json", mode="r") as signature_file:
+      signature = json.load(signature_file)
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(export_path, mode="rb") as graph_file:
+      graph_def.ParseFromString(graph_file.read())
+    tf.import_graph_def(graph_def, name="")
+    self.batch_size = 1
+    self.num_towers = 1
+    self._bind(tf.get_default_graph(), signature)
+
+  def step(self, session, encoder_inputs, decoder_inputs, target_weights,
+           bucket_id, forward_only, prob, beam_size=1, run_metadata=None):
+    """Run a forward-only step, see Seq2SeqModel.step.
+
+    Returns:
+      (None, None, None, outputs), as the frozen graph has no losses.
+
+    Raises:
+      ValueError: if forward_only is not set, or the input sizes disagree
+        with the bucket.
+    """
+    if not forward_only:
+      raise ValueError("A frozen model can only run forward-only steps.")
+    input_feed = self._step_feed(encoder_inputs, decoder_inputs,
+                                 target_weights, bucket_id, prob)
+    outputs = session.run(self._output_logits_feed(bucket_id), input_feed,
+                          run_metadata=run_metadata)
+    return None, None, None, self._output_logits(outputs)
+
+
+def _signature_names(signature, keys):
+  """The tensor names under keys of an inference signature, flattened."""
+  names = []
+  for key in keys:
+    values = [signature[key]]
+    while values:
+      value = values.pop()
+      if isinstance(value, list):
+        values.extend(value)
+      elif value is not None:
+        names.append(value)
+  return names
+
+
+def export_inference_graph(session, model, export_path):
+  """Write a forward-only model as a frozen, pruned graph for FrozenModel.
+
+  The graph is pruned to the nodes the means, logvars and output logits of
+  the buckets depend on, plus the input placeholders, and its variables are
+  replaced by constants with their values in session. Constants are folded
+  as well where TransformGraph is available. The inference signature of the
+  model goes to export_path + ".json".
+
+  Returns:
+    The written GraphDef.
+  """
+  signature = model.inference_signature()
+  inputs = sorted(set(name.split(":")[0] for name in
+                      _signature_names(signature, _SIGNATURE_INPUTS)))
+  outputs = sorted(set(name.split(":")[0] for name in
+                       _signature_names(signature, _SIGNATURE_OUTPUTS)))
+  graph_def = graph_util.convert_variables_to_constants(
+      session, session.graph.as_graph_def(), inputs + outputs)
+  if TransformGraph is not None:
+    graph_def = TransformGraph(graph_def, inputs, outputs,
+                               ["fold_constants(ignore_errors=true)"])
+  with tf.gfile.GFile(export_path, mode="wb") as graph_file:
+    graph_file.write(graph_def.SerializeToString())
+  with tf.gfile.GFile(export_path + ".json", mode="w") as signature_file:
+    json.dump(signature, signature_file, indent=2)
+  return graph_def
+
+
+def _cell_variable_renames():
+  """Pairs of names of a default and a block cell variable of the same weights.
+
+  The names are those the cells of the installed TensorFlow create, e.g.
+  GRUCell/Gates/Linear/Matrix and GRUBlockCell/w_ru of gru_ops, read off a
+  throwaway graph once. Both cells of a pair create their variables in the
+  same order, which pairs them up.
+  """
+  global _cell_renames
+  if _cell_renames is None:
+    renames = []
+    with tf.Graph().as_default():
+      inputs = tf.zeros([1, 1])
+      for i, make_cells in enumerate(_CELL_PAIRS):
+        names = []
+        for backend, make_cell in zip(_CELL_BACKENDS, make_cells):
+          with tf.variable_scope("%s_%d" % (backend, i)) as scope:
+            cell = make_cell(1)
+            cell(inputs, cell.zero_state(1, tf.float32))
+          names.append([variable.op.name[len(scope.name) + 1:]
+                        for variable in tf.global_variables()
+                        if variable.op.name.startswith(scope.name + "/")])
+        renames.extend(zip(*names))
+    _cell_renames = renames
+  return _cell_renames
+
+
+@contextlib.contextmanager
+def _tower_scope(k, num_towers):
+  """Places the ops of tower k on its own CPU device, if there are towers.
+
+  All CPU devices run their ops on the one intra-op thread pool of the
+  process; a device is not a partition of threads.
+  """
+  if num_towers == 1:
+    yield
+  else:
+    with tf.device("/cpu:%d" % k), tf.name_scope("tower_%d" % k):
+      yield
+
+
+def _concat_towers(towers, single_graph):
+  """Means, logvars and outputs of the whole batch from those of the towers."""
+  if len(towers) == 1:
+    return towers[0].means, towers[0].logvars, towers[0].outputs
+  means = [tf.concat(0, list(tower_means))
+           for tower_means in zip(*[tower.means for tower in towers])]
+  logvars = [tf.concat(0, list(tower_logvars))
+             for tower_logvars in zip(*[tower.logvars for tower in towers])]
+  if single_graph:
+    outputs = tf.concat(1, [tower.outputs for tower in towers])
+  else:
+    outputs = [[tf.concat(0, list(step_outputs))
+                for step_outputs in zip(*bucket_outputs)]
+               for bucket_outputs in zip(*[tower.outputs for tower in towers])]
+  return means, logvars, outputs
+
+
+def _average_gradients(tower_gradients):
+  """Averages the gradients of every variable over the towers."""
+  if len(tower_gradients) == 1:
+    return tower_gradients[0]
+  averaged = []
+  for gradients in zip(*tower_gradients):
+    if gradients[0] is None:
+      averaged.append(None)
+    elif isinstance(gradients[0], tf.IndexedSlices):
+      # Sparse embedding gradients stay sparse.
+      averaged.append(tf.IndexedSlices(
+          tf.concat(0, [g.values for g in gradients]) / len(gradients),
+          tf.concat(0, [g.indices for g in gradients]),
+          gradients[0].dense_shape))
+    else:
+      averaged.append(tf.add_n(list(gradients)) / len(gradients))
+  return averaged
+
+
+def _accumulate(accumulators, gradients):
+  """Op adding gradients to their accumulators; sparse ones stay sparse."""
+  updates = []
+  for accumulator, gradient in zip(accumulators, gradients):
+    if gradient is None:
+      continue
+    if isinstance(gradient, tf.IndexedSlices):
+      updates.append(tf.scatter_add(accumulator, gradient.indices,
+                                    gradient.values))
+    else:
+      updates.append(tf.assign_add(accumulator, gradient))
+  return tf.group(*updates)
+
+
+def _dynamic_encoder_feed(encoder_inputs):
+  """Converts encoder inputs as made by make_batch for a dynamic encoder.
+
+  make_batch pads each reversed source sentence on the left, so that the
+  static encoder reads it up to its last step. The dynamic encoder instead
+  wants every row to start with the sentence and stops at its length, so
+  each row is rotated left by its number of padding symbols; the sentence is
+  still read in reverse.
+
+  Returns:
+    A pair of the int32 [batch_size, encoder_size] inputs and the int32
+    [batch_size] sentence lengths.
+  """
+  rows = np.asarray(encoder_inputs, dtype=np.int32).T
+  encoder_size = rows.shape[1]
+  lengths = np.sum(rows != data_utils.PAD_ID, axis=1, dtype=np.int32)
+  num_pads = encoder_size - lengths
+  columns = (np.arange(encoder_size)[None, :] + num_pads[:, None]) % encoder_size
+  return rows[np.arange(len(rows))[:, None], columns], lengths
+
+
+def _pad_rows(rows, width):
+  """Packs token-id sequences into a [len(rows), width] PAD_ID-padded array."""
+  lengths = np.array([len(row) for row in rows], dtype=np.int64)
+  if rows and isinstance(rows[0], np.ndarray):
+    flat = np.concatenate(rows)
+  else:
+    flat = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int32,
+                       count=int(lengths.sum()))
+  batch = np.full([len(rows), width], data_utils.PAD_ID, dtype=np.int32)
+  batch[np.arange(width) < lengths[:, None]] = flat
+  return batch
@@ -0,0 +1,52 @@
+"""Tests for seq2seq_model; run with
+  python -m unittest seq2seq_model_test
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import tensorflow as tf
+
+import seq2seq_model
+
+
+class CellBackendRestoreTest(tf.test.TestCase):
+
+  def _build(self, cell_backend, use_lstm):
+    return seq2seq_model.Seq2SeqModel(
+        10, 10, [(3, 4)], 8, 1, 4, max_gradient_norm=5.0, batch_size=2,
+        learning_rate=0.001, use_lstm=use_lstm, forward_only=True,
+        weight_initializer=tf.uniform_unit_scaling_initializer,
+        bias_initializer=tf.zeros_initializer, cell_backend=cell_backend)
+
+  def _checkRestore(self, save_backend, restore_backend, use_lstm):
+    checkpoint_path = os.path.join(
+        self.get_temp_dir(),
+        "%s_%s_%d.ckpt" % (save_backend, restore_backend, use_lstm))
+    with tf.Graph().as_default(), self.test_session() as sess:
+      model = self._build(save_backend, use_lstm)
+      sess.run(tf.global_variables_initializer())
+      saved = sess.run(tf.global_variables())
+      model.saver.save(sess, checkpoint_path)
+    with tf.Graph().as_default(), self.test_session() as sess:
+      model = self._build(restore_backend, use_lstm)
+      model.restore(sess, checkpoint_path)
+      restored = sess.run(tf.global_variables())
+    # Both backends create their variables in the same order.
+    self.assertEqual(len(saved), len(restored))
+    for saved_value, restored_value in zip(saved, restored):
+      self.assertAllEqual(saved_value, restored_value)
+
+  def testRestoreGRUAcrossBackends(self):
+    self._checkRestore("default", "block", False)
+    self._checkRestore("block", "default", False)
+
+  def testRestoreLSTMAcrossBackends(self):
+    self._checkRestore("default", "block", True)
+    self._checkRestore("block", "default", True)
+
+
+if __name__ == "__main__":
+  tf.test.main()
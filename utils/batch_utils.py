@@ -0,0 +1,579 @@
+"""Utilities for producing training batches."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import array
+import struct
+import sys
+import threading
+
+import numpy as np
+from six.moves import queue
+from six.moves import xrange  # pylint: disable=redefined-builtin
+from six.moves import zip     # pylint: disable=redefined-builtin
+
+import utils.data_utils as data_utils
+
+
+class BatchPrefetcher(object):
+  """Produces batches on background threads ahead of the training loop.
+
+  produce_fn is called over and over on num_threads daemon threads and its
+  results are kept in a queue of at most queue_depth items, so the producers
+  run at most queue_depth batches ahead of the consumer calling get(). An
+  exception raised by produce_fn is re-raised by get().
+  """
+
+  def __init__(self, produce_fn, queue_depth, num_threads=1):
+    self._produce_fn = produce_fn
+    self._queue = queue.Queue(maxsize=queue_depth)
+    self._stop = threading.Event()
+    self._threads = [threading.Thread(target=self._run)
+                     for _ in xrange(num_threads)]
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  def _run(self):
+    while not self._stop.is_set():
+      try:
+        item = (self._produce_fn(), None)
+      except Exception as e:  # pylint: disable=broad-except
+        item = (None, e)
+      while not self._stop.is_set():
+        try:
+          self._queue.put(item, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+      if item[1] is not None:
+        return
+
+  def get(self):
+    """Returns the next produced item, waiting for one if necessary."""
+    item, error = self._queue.get()
+    if error is not None:
+      raise error
+    return item
+
+  def close(self):
+    """Stops and joins the producer threads."""
+    self._stop.set()
+    for thread in self._threads:
+      thread.join()
+
+
+# The array.array typecode of int64 items; Python 2 has no "q".
+_INT64_TYPECODE = np.dtype(np.int64).char
+
+
+class CompactBucket(object):
+  """Array-backed storage for the (source, target) examples of one bucket.
+
+  The token-ids of all examples live in one flat int32 array and every
+  example is described by the offsets and lengths of its source and target
+  in it, which takes about 4 bytes per token instead of a Python list entry
+  and int object each. With dedup set, an example whose target is its source
+  followed by EOS_ID, as in the autoencoder case, stores its tokens only once
+  and the source is a prefix of the target.
+
+  Examples are added with append() and the storage is turned into numpy
+  arrays by freeze(), or a frozen bucket is made from a binary corpus at
+  once by from_token_ids(). Indexing then returns a (source, target) pair of int32
+  views, so a CompactBucket can stand in for a list of examples everywhere
+  data sets are used, e.g. in Seq2SeqModel.get_batch.
+  """
+
+  def __init__(self, dedup=True):
+    self.dedup = dedup
+    self._tokens = array.array("i")
+    self._source_offsets = array.array(_INT64_TYPECODE)
+    self._source_lengths = array.array("i")
+    self._target_offsets = array.array(_INT64_TYPECODE)
+    self._target_lengths = array.array("i")
+    self._frozen = False
+
+  def append(self, source_ids, target_ids):
+    """Adds one example; must be called before freeze()."""
+    if self._frozen:
+      raise ValueError("Cannot append to a frozen CompactBucket.")
+    target_offset = len(self._tokens)
+    if (self.dedup and len(target_ids) == len(source_ids) + 1 and
+        target_ids[-1] == data_utils.EOS_ID and
+        list(target_ids[:-1]) == list(source_ids)):
+      source_offset = target_offset
+    else:
+      source_offset = target_offset
+      self._tokens.extend(source_ids)
+      target_offset = len(self._tokens)
+    self._tokens.extend(target_ids)
+    self._source_offsets.append(source_offset)
+    self._source_lengths.append(len(source_ids))
+    self._target_offsets.append(target_offset)
+    self._target_lengths.append(len(target_ids))
+
+  @classmethod
+  def from_token_ids(cls, sources, targets, indices, dedup=True):
+    """Makes a frozen bucket of sentence pairs of a binary corpus.
+
+    The arrays are built by vectorized gathers from the memory-mapped
+    corpora, without a Python object per example.
+
+    Args:
+      sources: data_utils.TokenIds of the source language.
+      targets: the aligned data_utils.TokenIds of the target language; every
+        target gets its EOS_ID.
+      indices: int array of the sentence pairs to store.
+      dedup: as in the constructor.
+    """
+    source_offsets = sources.offsets[indices]
+    source_lengths = sources.lengths[indices].astype(np.int64)
+    target_offsets = targets.offsets[indices]
+    target_lengths = targets.lengths[indices].astype(np.int64) + 1
+    duplicate = np.zeros([len(indices)], dtype=bool)
+    if dedup:
+      candidates = np.flatnonzero(
+          (target_lengths == source_lengths + 1) &
+          (targets.tokens[target_offsets + target_lengths - 1] ==
+           data_utils.EOS_ID))
+      lengths = source_lengths[candidates]
+      differs = (
+          sources.tokens[_spans(source_offsets[candidates], lengths)] !=
+          targets.tokens[_spans(target_offsets[candidates], lengths)])
+      duplicate[candidates] = _span_sums(differs, lengths) == 0
+
+    # Examples are laid out as append() does.
+    stored_source_lengths = np.where(duplicate, 0, source_lengths)
+    stored_lengths = stored_source_lengths + target_lengths
+    starts = np.cumsum(stored_lengths) - stored_lengths
+    tokens = np.empty([int(np.sum(stored_lengths))], dtype=np.int32)
+    tokens[_spans(starts, stored_source_lengths)] = sources.tokens[
+        _spans(source_offsets, stored_source_lengths)]
+    tokens[_spans(starts + stored_source_lengths, target_lengths)] = (
+        targets.tokens[_spans(target_offsets, target_lengths)])
+
+    bucket = cls(dedup=dedup)
+    bucket._tokens = tokens
+    bucket._source_offsets = starts
+    bucket._source_lengths = source_lengths.astype(np.int32)
+    bucket._target_offsets = starts + stored_source_lengths
+    bucket._target_lengths = target_lengths.astype(np.int32)
+    bucket._frozen = True
+    return bucket
+
+  def freeze(self):
+    """Turns the storage into numpy arrays; returns self."""
+    if not self._frozen:
+      self._tokens = np.frombuffer(self._tokens, dtype=np.int32)
+      self._source_offsets = np.frombuffer(self._source_offsets, dtype=np.int64)
+      self._source_lengths = np.frombuffer(self._source_lengths, dtype=np.int32)
+      self._target_offsets = np.frombuffer(self._target_offsets, dtype=np.int64)
+      self._target_lengths = np.frombuffer(self._target_lengths, dtype=np.int32)
+      self._frozen = True
+    return self
+
+  def example_lengths(self):
+    """Source and target lengths of all examples as two int32 arrays."""
+    self.freeze()
+    return self._source_lengths, self._target_lengths
+
+  @property
+  def nbytes(self):
+    """Number of bytes used by the frozen arrays."""
+    return sum(a.nbytes for a in (
+        self._tokens, self._source_offsets, self._source_lengths,
+        self._target_offsets, self._target_lengths))
+
+  def list_nbytes(self):
+    """Estimated bytes the examples would take as lists of Python ints.
+
+    That is how read_data keeps text token-ids without compact_buckets: a
+    [source, target] list per example, a list of ints for each, and an int
+    object per token-id above 256, the largest one CPython shares.
+    """
+    self.freeze()
+    large = np.zeros([len(self._tokens) + 1], dtype=np.int64)
+    np.cumsum(self._tokens > 256, out=large[1:])
+    num_large = sum(
+        int(np.sum(large[offsets + lengths] - large[offsets]))
+        for offsets, lengths in ((self._source_offsets, self._source_lengths),
+                                 (self._target_offsets, self._target_lengths)))
+    num_tokens = int(np.sum(self._source_lengths) +
+                     np.sum(self._target_lengths))
+    pointer = struct.calcsize("P")
+    return (len(self) * (pointer + sys.getsizeof([None, None]) +
+                         2 * sys.getsizeof([])) +
+            num_tokens * pointer + num_large * sys.getsizeof(1 << 20))
+
+  def __len__(self):
+    return len(self._source_lengths)
+
+  def __getitem__(self, i):
+    source_offset = self._source_offsets[i]
+    target_offset = self._target_offsets[i]
+    return (self._tokens[source_offset:source_offset + self._source_lengths[i]],
+            self._tokens[target_offset:target_offset + self._target_lengths[i]])
+
+
+def _spans(starts, lengths):
+  """Positions of the spans [start, start + length), concatenated."""
+  ends = np.cumsum(lengths)
+  return (np.arange(ends[-1] if len(ends) else 0, dtype=np.int64) +
+          np.repeat(starts - (ends - lengths), lengths))
+
+
+def _span_sums(values, lengths):
+  """Sums of consecutive spans of values with the given lengths."""
+  sums = np.zeros([len(values) + 1], dtype=np.int64)
+  np.cumsum(values, out=sums[1:])
+  ends = np.cumsum(lengths)
+  return sums[ends] - sums[ends - lengths]
+
+
+class TokenIdsBucket(object):
+  """The examples of one bucket of a binary token-ids corpus, as indices.
+
+  Only the indices of the sentence pairs in the memory-mapped corpora are
+  stored. Indexing returns a (source, target) pair of zero-copy int32 views,
+  the target followed by its EOS_ID, so the views are only made for the
+  examples of a batch when it is built.
+  """
+
+  def __init__(self, sources, targets, indices):
+    """Create the bucket.
+
+    Args:
+      sources: data_utils.TokenIds of the source language.
+      targets: the aligned data_utils.TokenIds of the target language.
+      indices: int64 array of the sentence pairs in the bucket.
+    """
+    self._sources = sources
+    self._targets = targets
+    self._indices = indices
+
+  def example_lengths(self):
+    """Source and target lengths of all examples as two int32 arrays."""
+    return (self._sources.lengths[self._indices],
+            self._targets.lengths[self._indices] + 1)
+
+  def __len__(self):
+    return len(self._indices)
+
+  def __getitem__(self, i):
+    j = self._indices[i]
+    return self._sources[j], self._targets.with_eos(j)
+
+
+class StreamingDataSource(object):
+  """Streams training batches from token-id shards without loading them.
+
+  Pairs of source and target shards are read lazily one sentence at a time
+  and every pair is put into the first bucket it fits, exactly as read_data
+  does. Each bucket keeps a shuffle buffer of at most buffer_size examples;
+  once a buffer is full, batch_size examples drawn at random from it make up
+  the next batch. Memory use is therefore bounded by the buffer sizes, not by
+  the size of the corpus. The shards are read over and over, so the source
+  never runs dry, unless a whole pass puts no sentence into a bucket.
+
+  A bucket whose buffer does not fill up during a pass holds every example
+  of the bucket in that pass. Instead of reading the next pass into it too,
+  which would buffer copies of the same examples, it is emptied at the end
+  of the pass: its examples are shuffled and cut into batches, the last one
+  topped up with other examples of the pass.
+  """
+
+  def __init__(self, source_paths, target_paths, buckets, batch_size,
+               buffer_size, binary=False, max_size=None, shard_index=0,
+               num_shards=1):
+    """Create the data source.
+
+    Args:
+      source_paths: list of paths to token-id files for the source language.
+      target_paths: list of paths to the aligned target token-id files.
+      buckets: a list of pairs (I, O) as in Seq2SeqModel.
+      batch_size: number of examples in a batch.
+      buffer_size: maximum number of examples buffered per bucket; must not
+        be smaller than batch_size.
+      binary: Boolean; whether the shards are in the binary corpus format.
+      max_size: if set, only the first max_size sentences of every pass over
+        the shards are used.
+      shard_index, num_shards: only every num_shards-th sentence, starting
+        with sentence shard_index, is used, so that num_shards sources
+        stream disjoint parts of the data.
+    """
+    if buffer_size < batch_size:
+      raise ValueError("buffer_size (%d) must be at least batch_size (%d)."
+                       % (buffer_size, batch_size))
+    self.buckets = buckets
+    self.batch_size = batch_size
+    self.buffer_size = buffer_size
+    self._shards = list(zip(source_paths, target_paths))
+    self._binary = binary
+    self._max_size = max_size
+    self._shard_index = shard_index
+    self._num_shards = num_shards
+    self._buffers = [[] for _ in buckets]
+    # Whether the buffer of a bucket filled up in the current pass.
+    self._filled = [False for _ in buckets]
+    # Batches of emptied buffers, still to be returned.
+    self._pending = []
+    # Number of examples put into a bucket in the current pass.
+    self._num_placed = 0
+    self._examples = self._read_examples()
+    self._lock = threading.Lock()
+
+  def _read_examples(self):
+    """Yields (source_ids, target_ids) pairs, and None after every pass."""
+    while True:
+      counter = 0
+      for source_path, target_path in self._shards:
+        sources = data_utils.iter_token_ids(source_path, self._binary)
+        targets = data_utils.iter_token_ids(target_path, self._binary,
+                                            append_eos=True)
+        for source_ids, target_ids in zip(sources, targets):
+          if self._max_size and counter >= self._max_size:
+            break
+          counter += 1
+          if (counter - 1) % self._num_shards == self._shard_index:
+            yield source_ids, target_ids
+      if counter <= self._shard_index:
+        raise ValueError("No training data in %s." % self._shards)
+      yield None
+
+  def next_batch(self):
+    """Returns (bucket_id, examples) for the next batch; thread-safe.
+
+    Raises:
+      ValueError: if no sentence of the shards fits into any bucket.
+    """
+    with self._lock:
+      while True:
+        if self._pending:
+          return self._pending.pop()
+        example = next(self._examples)
+        if example is None:
+          if not self._num_placed:
+            raise ValueError("No sentence in %s fits into any of the buckets "
+                             "%s." % (self._shards, self.buckets))
+          self._num_placed = 0
+          self._empty_unfilled_buffers()
+          continue
+        source_ids, target_ids = example
+        for bucket_id, (source_size, target_size) in enumerate(self.buckets):
+          if len(source_ids) < source_size and len(target_ids) < target_size:
+            self._num_placed += 1
+            buf = self._buffers[bucket_id]
+            buf.append((source_ids, target_ids))
+            if len(buf) == self.buffer_size:
+              self._filled[bucket_id] = True
+              return bucket_id, self._take(buf)
+            break
+
+  def _empty_unfilled_buffers(self):
+    """Cuts the buffers that did not fill up in the past pass into batches."""
+    for bucket_id, buf in enumerate(self._buffers):
+      if buf and not self._filled[bucket_id]:
+        order = np.random.permutation(len(buf))
+        num_batches = -(-len(buf) // self.batch_size)
+        for example_ids in np.resize(order, [num_batches, self.batch_size]):
+          self._pending.append(
+              (bucket_id, [buf[i] for i in example_ids]))
+        del buf[:]
+      self._filled[bucket_id] = False
+
+  def _take(self, buf):
+    # Remove random positions from the highest down by swapping in the last
+    # element, so every removal is O(1) and indices stay valid.
+    positions = np.sort(np.random.choice(len(buf), self.batch_size,
+                                         replace=False))[::-1]
+    examples = []
+    for position in positions:
+      examples.append(buf[position])
+      buf[position] = buf[-1]
+      buf.pop()
+    return examples
+
+
+def _example_lengths(bucket):
+  if hasattr(bucket, "example_lengths"):
+    return bucket.example_lengths()
+  return (np.array([len(source) for source, _ in bucket], dtype=np.int32),
+          np.array([len(target) for _, target in bucket], dtype=np.int32))
+
+
+class EpochSampler(object):
+  """Walks epochs over bucketed data without replacement, resumably.
+
+  At the start of every epoch the examples of each bucket are permuted and
+  cut into batches, and the batches of all buckets are shuffled, so every
+  example is seen exactly once per epoch and buckets are visited in
+  proportion to their sizes. A bucket whose size is not a multiple of
+  batch_size has its last batch topped up with examples from the start of
+  its epoch.
+
+  next_batch() returns the position after the batch along with it, which
+  holds on to the plan of the batch's epoch. save() writes that plan, the
+  position and the random state to a file, and restore() continues from
+  there exactly, also when batches were prefetched past it or any number of
+  epochs ahead.
+
+  The sampler counts the real tokens of the batches it hands out together
+  with the positions they would take when padded to the longest example of
+  each batch, and when padded to the bucket size.
+  """
+
+  def __init__(self, data_set, buckets, batch_size, seed=None):
+    self.buckets = buckets
+    self.batch_size = batch_size
+    self.epoch = 0
+    self._lengths = [_example_lengths(bucket) for bucket in data_set]
+    self._rng = np.random.RandomState(seed)
+    self._lock = threading.Lock()
+    self._real_tokens = 0
+    self._batch_padded_tokens = 0
+    self._bucket_padded_tokens = 0
+    self._new_epoch()
+
+  def _bucket_batches(self, bucket_id, order):
+    """Cuts a permutation of one bucket into an [n, batch_size] array."""
+    num_batches = -(-len(order) // self.batch_size)
+    return np.resize(order, [num_batches, self.batch_size])
+
+  def _new_epoch(self):
+    bucket_ids = []
+    example_ids = []
+    for bucket_id, (source_lengths, _) in enumerate(self._lengths):
+      if len(source_lengths):
+        batches = self._bucket_batches(
+            bucket_id, self._rng.permutation(len(source_lengths)))
+        bucket_ids.append(np.full([len(batches)], bucket_id, dtype=np.int32))
+        example_ids.append(batches)
+    if not bucket_ids:
+      raise ValueError("No training data to make batches from.")
+    order = self._rng.permutation(sum(len(ids) for ids in bucket_ids))
+    self._bucket_ids = np.concatenate(bucket_ids)[order]
+    self._example_ids = np.concatenate(example_ids)[order]
+    self._position = 0
+    self._plan = (self._bucket_ids, self._example_ids, self._rng.get_state())
+
+  @property
+  def num_batches(self):
+    """Number of batches in an epoch."""
+    return len(self._bucket_ids)
+
+  def next_batch(self):
+    """Returns (bucket_id, example_ids, position) of the next batch.
+
+    position is the (epoch, batch index, plan of the epoch) right after this
+    batch, to be passed to save() once the batch has been trained on. This
+    method is thread-safe.
+    """
+    with self._lock:
+      if self._position == self.num_batches:
+        self.epoch += 1
+        self._new_epoch()
+      bucket_id = int(self._bucket_ids[self._position])
+      example_ids = self._example_ids[self._position]
+      self._position += 1
+      self._count_tokens(bucket_id, example_ids)
+      return bucket_id, example_ids, (self.epoch, self._position, self._plan)
+
+  def save(self, path, position):
+    """Saves the state of the sampler at position to the file path."""
+    epoch, batch_index, (bucket_ids, example_ids, rng_state) = position
+    _, keys, pos, has_gauss, cached_gaussian = rng_state
+    with open(path, "wb") as f:
+      np.savez(f, epoch=epoch, position=batch_index, bucket_ids=bucket_ids,
+               example_ids=example_ids, rng_keys=keys, rng_pos=pos,
+               rng_has_gauss=has_gauss, rng_cached_gaussian=cached_gaussian)
+
+  def restore(self, path):
+    """Continues from the state saved to the file path.
+
+    Raises:
+      ValueError: if the saved state does not fit the data or batch size.
+    """
+    with open(path, "rb") as f:
+      state = dict(np.load(f))
+    bucket_ids = state["bucket_ids"]
+    example_ids = state["example_ids"]
+    if example_ids.shape[1:] != (self.batch_size,) or any(
+        len(example_ids[bucket_ids == bucket_id]) and
+        example_ids[bucket_ids == bucket_id].max() >= len(lengths)
+        for bucket_id, (lengths, _) in enumerate(self._lengths)):
+      raise ValueError("Sampler state in %s does not match the training data."
+                       % path)
+    with self._lock:
+      self.epoch = int(state["epoch"])
+      self._bucket_ids = bucket_ids
+      self._example_ids = example_ids
+      self._position = int(state["position"])
+      self._rng.set_state(("MT19937", state["rng_keys"], int(state["rng_pos"]),
+                           int(state["rng_has_gauss"]),
+                           float(state["rng_cached_gaussian"])))
+      self._plan = (self._bucket_ids, self._example_ids,
+                    self._rng.get_state())
+
+  def _count_tokens(self, bucket_id, example_ids):
+    source_lengths, target_lengths = self._lengths[bucket_id]
+    sources = source_lengths[example_ids]
+    # The decoder additionally gets the GO symbol.
+    targets = target_lengths[example_ids] + 1
+    encoder_size, decoder_size = self.buckets[bucket_id]
+    real = int(sources.sum() + targets.sum())
+    self._real_tokens += real
+    self._batch_padded_tokens += (len(example_ids) *
+                                  int(sources.max() + targets.max()) - real)
+    self._bucket_padded_tokens += (len(example_ids) *
+                                   (encoder_size + decoder_size) - real)
+
+  def padded_fractions(self):
+    """Fractions of padding when padding to the batch and to the bucket size."""
+    with self._lock:
+      batch_total = self._real_tokens + self._batch_padded_tokens
+      bucket_total = self._real_tokens + self._bucket_padded_tokens
+      return (self._batch_padded_tokens / float(max(batch_total, 1)),
+              self._bucket_padded_tokens / float(max(bucket_total, 1)))
+
+
+class LengthSortedBatcher(EpochSampler):
+  """An EpochSampler that cuts epochs into batches of similar lengths.
+
+  The permutation of every bucket is split into chunks of
+  chunk_batches * batch_size examples and every chunk is sorted by length
+  before it is cut into batches. Examples in a batch therefore differ little
+  in length, which keeps the padding up to the longest example of a batch
+  small, while chunks and batch order are still random. A bucket whose size
+  is not a multiple of batch_size has its last, longest batch topped up with
+  the examples right before it in sorted order, which are of similar length.
+  """
+
+  def __init__(self, data_set, buckets, batch_size, chunk_batches=100,
+               seed=None):
+    self.chunk_size = chunk_batches * batch_size
+    super(LengthSortedBatcher, self).__init__(data_set, buckets, batch_size,
+                                              seed)
+
+  def _bucket_batches(self, bucket_id, order):
+    source_lengths, target_lengths = self._lengths[bucket_id]
+    starts = list(xrange(0, len(order), self.chunk_size))
+    if len(starts) > 1 and len(order) - starts[-1] < self.batch_size:
+      # A last chunk shorter than a batch is sorted with the one before it,
+      # so that the last batch is cut from a single sorted chunk.
+      starts.pop()
+    chunks = []
+    for start, end in zip(starts, starts[1:] + [len(order)]):
+      chunk = order[start:end]
+      chunks.append(
+          chunk[np.lexsort((target_lengths[chunk], source_lengths[chunk]))])
+    order = np.concatenate(chunks)
+    num_full = len(order) // self.batch_size
+    batches = order[:num_full * self.batch_size].reshape(
+        [num_full, self.batch_size])
+    if num_full * self.batch_size < len(order):
+      # A bucket smaller than a batch repeats its examples to fill it.
+      tail = (order[-self.batch_size:] if num_full
+              else np.resize(order, [self.batch_size]))
+      batches = np.concatenate([batches, tail[np.newaxis]])
+    return batches
@@ -0,0 +1,160 @@
+"""Utilities for choosing bucket sizes from the lengths in a corpus."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+from six.moves import zip     # pylint: disable=redefined-builtin
+
+import utils.data_utils as data_utils
+
+
+# The result of evaluating a list of buckets on a length histogram.
+#   buckets: the list of [I, O] buckets.
+#   num_sentences: number of sentences in the histogram.
+#   dropped: number of sentences that fit no bucket.
+#   padded_fraction: fraction of the encoder and decoder positions of the
+#     kept sentences that are padding.
+#   graph_steps: number of encoder and decoder steps unrolled over all
+#     buckets, which is what the size of the model graph grows with.
+BucketPlan = collections.namedtuple(
+    "BucketPlan",
+    ["buckets", "num_sentences", "dropped", "padded_fraction", "graph_steps"])
+
+
+def length_histogram(source_path, target_path, binary=False):
+  """Counts the sentence pairs of two aligned token-id files by their lengths.
+
+  Args:
+    source_path: path to the token-ids for the source language.
+    target_path: path to the aligned token-ids for the target language.
+    binary: Boolean; whether the files are in the binary corpus format.
+
+  Returns:
+    A collections.Counter mapping (source length, target length) to the
+    number of sentence pairs of these lengths; target lengths do not include
+    the EOS symbol read_data appends.
+  """
+  if binary:
+    sources = data_utils.TokenIds(source_path)
+    targets = data_utils.TokenIds(target_path)
+    size = min(len(sources), len(targets))
+    return collections.Counter(zip(sources.lengths[:size].tolist(),
+                                   targets.lengths[:size].tolist()))
+  return collections.Counter(
+      (len(source_ids), len(target_ids)) for source_ids, target_ids in zip(
+          data_utils.iter_token_ids(source_path),
+          data_utils.iter_token_ids(target_path)))
+
+
+def evaluate_buckets(histogram, buckets):
+  """Returns the BucketPlan of putting the histogram into the given buckets.
+
+  Every sentence pair goes into the first bucket (I, O) with
+  source length < I and target length + 1 < O, as in read_data.
+  """
+  dropped = 0
+  slots = 0
+  real = 0
+  for (source_length, target_length), count in histogram.items():
+    for source_size, target_size in buckets:
+      if source_length < source_size and target_length + 1 < target_size:
+        slots += count * (source_size + target_size)
+        # The decoder gets GO, the target and EOS.
+        real += count * (source_length + target_length + 2)
+        break
+    else:
+      dropped += count
+  return BucketPlan(
+      buckets=[list(bucket) for bucket in buckets],
+      num_sentences=sum(histogram.values()),
+      dropped=dropped,
+      padded_fraction=(slots - real) / float(slots) if slots else 0.0,
+      graph_steps=sum(source_size + target_size
+                      for source_size, target_size in buckets))
+
+
+def plan_buckets(histogram, num_buckets, max_length, max_graph_steps=None,
+                 decoder_offset=1):
+  """Picks the buckets that minimize the padded positions of a histogram.
+
+  Buckets have the form (L, L + decoder_offset), like the default [18, 19]
+  of an autoencoder. Bucket boundaries are chosen by dynamic programming
+  over the distinct sentence lengths, so the total number of padded
+  positions is minimal among all plans of up to num_buckets buckets within
+  max_graph_steps; the largest bucket is the smallest one holding every
+  sentence of up to max_length tokens, longer sentences are dropped. For
+  every largest bucket and number of buckets, the dynamic program keeps
+  the plans no other plan beats in both graph steps and padding.
+
+  Args:
+    histogram: a length histogram as returned by length_histogram.
+    num_buckets: maximum number of buckets.
+    max_length: maximum source length, i.e. the largest L is max_length + 1.
+    max_graph_steps: if set, the graph_steps of the plan do not exceed it.
+    decoder_offset: difference between decoder and encoder size of a bucket.
+
+  Returns:
+    The BucketPlan of the chosen buckets.
+
+  Raises:
+    ValueError: if no sentence fits max_length or no plan fits into
+      max_graph_steps.
+  """
+  # Smallest encoder size L of a bucket (L, L + decoder_offset) that holds a
+  # sentence pair, and number of sentences per such L.
+  counts = collections.Counter()
+  for (source_length, target_length), count in histogram.items():
+    size = max(source_length + 1, target_length + 2 - decoder_offset)
+    if size <= max_length + 1:
+      counts[size] += count
+  if not counts:
+    raise ValueError("No sentence is shorter than max_length (%d)." % max_length)
+  sizes = sorted(counts)
+  # covered[j]: number of sentences fitting into a bucket of size sizes[j].
+  covered = []
+  total = 0
+  for size in sizes:
+    total += counts[size]
+    covered.append(total)
+
+  def width(size):
+    return 2 * size + decoder_offset
+
+  budget = max_graph_steps or float("inf")
+  # plans[j]: (graph steps, slots, boundaries) of the Pareto-optimal plans
+  # with the current number of buckets whose largest bucket has size
+  # sizes[j], within the budget.
+  plans = [_pareto_plans([(width(sizes[j]), covered[j] * width(sizes[j]),
+                           [sizes[j]])])
+           if width(sizes[j]) <= budget else []
+           for j in xrange(len(sizes))]
+  candidates = list(plans[-1])
+  for _ in xrange(1, min(num_buckets, len(sizes))):
+    plans = [_pareto_plans([
+        (steps + width(sizes[j]),
+         slots + (covered[j] - covered[i]) * width(sizes[j]),
+         boundaries + [sizes[j]])
+        for i in xrange(j) for steps, slots, boundaries in plans[i]
+        if steps + width(sizes[j]) <= budget])
+             for j in xrange(len(sizes))]
+    candidates.extend(plans[-1])
+  if not candidates:
+    raise ValueError("Even a single bucket exceeds max_graph_steps (%d)."
+                     % max_graph_steps)
+  # All plans hold the same sentences, so the fewest slots is the least
+  # padding.
+  _, _, boundaries = min(candidates, key=lambda plan: (plan[1], plan[0]))
+  return evaluate_buckets(histogram, [[size, size + decoder_offset]
+                                      for size in boundaries])
+
+
+def _pareto_plans(plans):
+  """The (graph steps, slots, boundaries) plans no other has fewer of both."""
+  pareto = []
+  for plan in sorted(plans, key=lambda plan: (plan[0], plan[1])):
+    if not pareto or plan[1] < pareto[-1][1]:
+      pareto.append(plan)
+  return pareto
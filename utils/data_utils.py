@@ -18,16 +18,32 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
+import collections
+import functools
 import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import multiprocessing.pool
 import os
-import re
 import tarfile
+import threading
+import time
 
+import numpy as np
+import six
 from six.moves import urllib
+from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from tensorflow.python.platform import gfile
 import tensorflow as tf
 
+from utils.tokenizer_utils import _DIGIT_RE
+from utils.tokenizer_utils import basic_tokenizer
+from utils.tokenizer_utils import fast_tokenizer
+
 # Special vocabulary symbols - we always put them at the start.
 _PAD = "_PAD"
 _GO = "_GO"
@@ -40,9 +56,11 @@ GO_ID = 1
 EOS_ID = 2
 UNK_ID = 3
 
-# Regular expressions used to tokenize.
-_WORD_SPLIT = re.compile("([.,!?\"':;)(])")
-_DIGIT_RE = re.compile(r"\d")
+# Suffixes of the three files that make up a binary token-ids corpus, see
+# BinaryTokenIdsWriter and TokenIds below.
+_TOKENS_SUFFIX = ".tokens"
+_OFFSETS_SUFFIX = ".offsets"
+_LENGTHS_SUFFIX = ".lengths"
 
 # URLs for WMT data.
 _WMT_ENFR_TRAIN_URL = "http://www.statmt.org/wmt10/training-giga-fren.tar"
@@ -72,22 +90,151 @@ def gunzip_file(gz_path, new_path):
         new_file.write(line)
 
 
-def basic_tokenizer(sentence):
-  """Very basic tokenizer: split the sentence into a list of tokens."""
-  words = []
-  for space_separated_fragment in sentence.strip().split():
-    words.extend(_WORD_SPLIT.split(space_separated_fragment))
-  return [w for w in words if w]
+class _TarMemberStream(object):
+  """Closes the archive together with the stream of one of its members."""
+
+  def __init__(self, archive, member_file):
+    self._archive = archive
+    self._stream = _text_lines(member_file)
+
+  def __iter__(self):
+    return iter(self._stream)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc):
+    self.close()
+
+  def close(self):
+    self._stream.close()
+    self._archive.close()
+
+
+def _text_lines(binary_file):
+  """binary_file read as GFile reads text: bytes on Python 2, text on 3."""
+  if six.PY2:
+    return binary_file
+  return io.TextIOWrapper(binary_file, encoding="utf-8")
+
+
+def _stream_file(path):
+  """The file a text stream path is read from: the archive of a member."""
+  return path.split("#", 1)[0]
+
+
+def _is_compressed_stream(path):
+  """Whether open_text_stream decompresses path while reading it."""
+  return "#" in path or path.endswith(".gz")
+
+
+def open_text_stream(path):
+  """Opens a text file, a gzipped file or a member of a tar archive for reading.
+
+  Compressed inputs are decompressed while they are read, nothing is
+  unpacked to disk. Every call opens a new stream, so a compressed input is
+  decompressed again for every pass over it; prepare_wmt_data reads each
+  training file twice, once for its vocabulary and once for its token-ids.
+  Lines are of the string type GFile reads, byte strings on Python 2 and
+  text on Python 3, whether the input is compressed or not.
+
+  Args:
+    path: a text file; a file ending in ".gz"; or "archive#member" for the
+      file member inside the tar archive archive, which may be compressed.
+
+  Returns:
+    A file-like object iterating over the lines of the text, to be used as a
+    context manager.
+
+  Raises:
+    ValueError: if the tar archive has no such member.
+  """
+  if "#" in path:
+    archive_path, member = path.split("#", 1)
+    archive = tarfile.open(archive_path, mode="r:*")
+    try:
+      member_file = archive.extractfile(member)
+    except KeyError:
+      member_file = None
+    if member_file is None:
+      archive.close()
+      raise ValueError("%s has no file member %s." % (archive_path, member))
+    return _TarMemberStream(archive, member_file)
+  if path.endswith(".gz"):
+    return _text_lines(gzip.open(path, "rb"))
+  return gfile.GFile(path, mode="r")
+
+
+def _count_tokens(vocab, line, tokenizer, normalize_digits):
+  """Adds the tokens of line to the token counts in vocab.
+
+  vocab is an OrderedDict, so its tokens are kept in the order of their
+  first occurrence.
+  """
+  if not tokenizer:
+    for word in fast_tokenizer(line, normalize_digits):
+      vocab[word] = vocab.get(word, 0) + 1
+    return
+  for w in tokenizer(line):
+    word = _DIGIT_RE.sub("0", w) if normalize_digits else w
+    if word in vocab:
+      vocab[word] += 1
+    else:
+      vocab[word] = 1
+
+
+def _count_shard_tokens(args):
+  """Counts the tokens of the lines starting in the byte range [start, end)."""
+  data_path, start, end, tokenizer, normalize_digits = args
+  vocab = collections.OrderedDict()
+  with open(data_path, "rb") as f:
+    if start > 0:
+      # Skip the line running into the shard; the previous shard counts it.
+      f.seek(start - 1)
+      f.readline()
+    position = f.tell()
+    while position < end:
+      line = f.readline()
+      if not line:
+        break
+      position += len(line)
+      # Lines are tokenized as the string type GFile reads, like sequentially.
+      _count_tokens(vocab, tf.compat.as_str(line), tokenizer,
+                    normalize_digits)
+  return vocab
+
+
+def _count_tokens_parallel(data_path, num_workers, tokenizer, normalize_digits):
+  """Counts tokens of data_path in num_workers processes, one per byte range.
+
+  Shard counts are merged in file order, so every token keeps the position of
+  its first occurrence in the file, as when counting sequentially.
+  """
+  size = os.path.getsize(data_path)
+  bounds = [size * i // num_workers for i in xrange(num_workers + 1)]
+  shards = [(data_path, bounds[i], bounds[i + 1], tokenizer, normalize_digits)
+            for i in xrange(num_workers)]
+  pool = multiprocessing.Pool(num_workers)
+  try:
+    shard_vocabs = pool.map(_count_shard_tokens, shards)
+  finally:
+    pool.close()
+    pool.join()
+  vocab = collections.OrderedDict()
+  for shard_vocab in shard_vocabs:
+    for word, count in shard_vocab.items():
+      vocab[word] = vocab.get(word, 0) + count
+  return vocab
 
 
 def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size, embedding_path,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True, num_workers=1):
   """Create vocabulary file (if it does not exist yet) from data file.
 
   Data file is assumed to contain one sentence per line. Each sentence is
   tokenized and digits are normalized (if normalize_digits is set).
-  Vocabulary contains the most-frequent tokens up to max_vocabulary_size.
-  We write it to vocabulary_path in a one-token-per-line format, so that later
+  Vocabulary contains the most-frequent tokens up to max_vocabulary_size,
+  tokens of equal counts in the order of their first occurrence. We write it to vocabulary_path in a one-token-per-line format, so that later
   token in the first line gets id=0, second line gets id=1, and so on.
 
   Args:
@@ -97,32 +244,36 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size, embedding
     tokenizer: a function to use to tokenize each data sentence;
       if None, basic_tokenizer will be used.
     normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    num_workers: number of processes counting tokens, each one over its own
+      byte range of data_path; the result is identical for any number.
+      Compressed data (see open_text_stream) is always counted by one process.
   """
   if not gfile.Exists(vocabulary_path) or not gfile.Exists(embedding_path):
     print("Creating vocabulary %s from data %s" % (vocabulary_path, data_path))
     print("Creating embedding file %s from data %s" % (embedding_path, data_path))
-    vocab = {}
-    with gfile.GFile(data_path, mode="r") as f:
-      counter = 0
-      for line in f:
-        counter += 1
-        if counter % 100000 == 0:
-          print("  processing line %d" % counter)
-        tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
-        for w in tokens:
-          word = _DIGIT_RE.sub("0", w) if normalize_digits else w
-          if word in vocab:
-            vocab[word] += 1
-          else:
-            vocab[word] = 1
-      vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
-      if len(vocab_list) > max_vocabulary_size:
-        vocab_list = vocab_list[:max_vocabulary_size]
-      with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
-        with gfile.GFile(embedding_path, mode="wb") as embedding_file:
-          for w in vocab_list:
-            vocab_file.write(w + "\n")
-            embedding_file.write(w + "\n")
+    if num_workers > 1 and not _is_compressed_stream(data_path):
+      vocab = _count_tokens_parallel(data_path, num_workers, tokenizer,
+                                     normalize_digits)
+    else:
+      vocab = collections.OrderedDict()
+      with open_text_stream(data_path) as f:
+        counter = 0
+        for line in f:
+          counter += 1
+          if counter % 100000 == 0:
+            print("  processing line %d" % counter)
+          _count_tokens(vocab, line, tokenizer, normalize_digits)
+    # Tokens of equal counts are ordered by their first occurrence.
+    words = list(vocab)
+    ranks = sorted(xrange(len(words)), key=lambda i: (-vocab[words[i]], i))
+    vocab_list = _START_VOCAB + [words[i] for i in ranks]
+    if len(vocab_list) > max_vocabulary_size:
+      vocab_list = vocab_list[:max_vocabulary_size]
+    with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
+      with gfile.GFile(embedding_path, mode="wb") as embedding_file:
+        for w in vocab_list:
+          vocab_file.write(w + "\n")
+          embedding_file.write(w + "\n")
 
 
 def initialize_vocabulary(vocabulary_path):
@@ -155,6 +306,139 @@ def initialize_vocabulary(vocabulary_path):
     raise ValueError("Vocabulary file %s not found.", vocabulary_path)
 
 
+_VOCABULARY_SUFFIX = ".bin"
+_VOCABULARY_MAGIC = b"VOCB"
+
+
+def compile_vocabulary(vocabulary_path, binary_path):
+  """Compiles a vocabulary file into the format read by BinaryVocabulary.
+
+  The binary file holds, after a 16 byte header of magic and size, the int64
+  offsets of every word into a packed UTF-8 string table, the int32 ids of
+  the words in byte order, and the string table itself.
+
+  Args:
+    vocabulary_path: path to the vocabulary file, one word per line.
+    binary_path: path where the binary vocabulary is written.
+  """
+  _, rev_vocab = initialize_vocabulary(vocabulary_path)
+  words = [tf.compat.as_bytes(word) for word in rev_vocab]
+  offsets = np.zeros([len(words) + 1], dtype=np.int64)
+  offsets[1:] = np.cumsum([len(word) for word in words])
+  index = np.array(sorted(xrange(len(words)), key=words.__getitem__),
+                   dtype=np.int32)
+  # Written to a temporary file first so that concurrent readers never see a
+  # partial vocabulary.
+  tmp_path = "%s.tmp%d" % (binary_path, os.getpid())
+  with open(tmp_path, "wb") as f:
+    f.write(_VOCABULARY_MAGIC)
+    f.write(np.array([len(words)], dtype="<i4").tobytes())
+    f.write(np.array([offsets[-1]], dtype="<i8").tobytes())
+    f.write(offsets.astype("<i8").tobytes())
+    f.write(index.astype("<i4").tobytes())
+    f.write(b"".join(words))
+  os.rename(tmp_path, binary_path)
+
+
+class BinaryVocabulary(object):
+  """A memory-mapped vocabulary written by compile_vocabulary.
+
+  Serves as both the vocabulary and the reversed vocabulary returned by
+  initialize_vocabulary: get(word, default) and `word in vocab` look up the
+  id of a word by binary search, and vocab[i] returns the word with id i.
+  Like initialize_vocabulary, a word listed more than once gets its last id.
+  Opening is O(1), only the pages that lookups touch are read. The ids of up
+  to cache_size looked-up words, including those not in the vocabulary, are
+  kept in a dict, so repeated words are not searched for again.
+  """
+
+  def __init__(self, binary_path, cache_size=100000):
+    data = _memmap(binary_path, np.uint8)
+    if data[:4].tobytes() != _VOCABULARY_MAGIC:
+      raise ValueError("%s is not a binary vocabulary." % binary_path)
+    size = int(data[4:8].view("<i4")[0])
+    start = 16
+    self._offsets = data[start:start + 8 * (size + 1)].view("<i8")
+    start += 8 * (size + 1)
+    self._index = data[start:start + 4 * size].view("<i4")
+    start += 4 * size
+    self._strings = data[start:]
+    self.cache_size = cache_size
+    self._cache = {}
+
+  def __len__(self):
+    return len(self._index)
+
+  def _word(self, token_id):
+    return self._strings[self._offsets[token_id]:
+                         self._offsets[token_id + 1]].tobytes()
+
+  def __getitem__(self, token_id):
+    if not 0 <= token_id < len(self):
+      raise IndexError("token id %d out of range" % token_id)
+    return tf.compat.as_str(self._word(token_id))
+
+  def _search(self, word):
+    """The id of word, or None; the last of several equal words wins."""
+    word = tf.compat.as_bytes(word)
+    # Equal words are stored in the order of their ids; find the last one.
+    low, high = 0, len(self._index)
+    while low < high:
+      middle = (low + high) // 2
+      if word < self._word(self._index[middle]):
+        high = middle
+      else:
+        low = middle + 1
+    if low > 0 and self._word(self._index[low - 1]) == word:
+      return int(self._index[low - 1])
+    return None
+
+  def get(self, word, default=None):
+    try:
+      token_id = self._cache[word]
+    except KeyError:
+      token_id = self._search(word)
+      if len(self._cache) < self.cache_size:
+        self._cache[word] = token_id
+    return default if token_id is None else token_id
+
+  def __contains__(self, word):
+    return self.get(word) is not None
+
+
+_loaded_vocabularies = {}
+_loaded_vocabularies_lock = threading.Lock()
+
+
+def load_vocabulary(vocabulary_path):
+  """Returns the BinaryVocabulary of a vocabulary file, loaded once per process.
+
+  The binary vocabulary is kept next to the vocabulary file and compiled
+  whenever it is missing or older than the vocabulary file.
+
+  Args:
+    vocabulary_path: path to the file containing the vocabulary.
+
+  Returns:
+    A BinaryVocabulary shared by all callers in this process.
+
+  Raises:
+    ValueError: if neither the vocabulary nor its binary version exist.
+  """
+  with _loaded_vocabularies_lock:
+    if vocabulary_path not in _loaded_vocabularies:
+      binary_path = vocabulary_path + _VOCABULARY_SUFFIX
+      if gfile.Exists(vocabulary_path) and (
+          not gfile.Exists(binary_path) or
+          gfile.Stat(binary_path).mtime_nsec <
+          gfile.Stat(vocabulary_path).mtime_nsec):
+        compile_vocabulary(vocabulary_path, binary_path)
+      elif not gfile.Exists(binary_path):
+        raise ValueError("Vocabulary file %s not found." % vocabulary_path)
+      _loaded_vocabularies[vocabulary_path] = BinaryVocabulary(binary_path)
+    return _loaded_vocabularies[vocabulary_path]
+
+
 def sentence_to_token_ids(sentence, vocabulary,
                           tokenizer=None, normalize_digits=True):
   """Convert a string to list of integers representing token-ids.
@@ -174,18 +458,264 @@ def sentence_to_token_ids(sentence, vocabulary,
     a list of integers, the token-ids for the sentence.
   """
 
-  if tokenizer:
-    words = tokenizer(sentence)
-  else:
-    words = basic_tokenizer(sentence)
+  if not tokenizer:
+    return [vocabulary.get(w, UNK_ID)
+            for w in fast_tokenizer(sentence, normalize_digits)]
+  words = tokenizer(sentence)
   if not normalize_digits:
     return [vocabulary.get(w, UNK_ID) for w in words]
   # Normalize digits by 0 before looking words up in the vocabulary.
   return [vocabulary.get(_DIGIT_RE.sub("0", w), UNK_ID) for w in words]
 
 
+class TokenIdCache(object):
+  """Bounded LRU cache in front of sentence_to_token_ids.
+
+  Up to max_size raw sentences are mapped to their token-ids, and up to
+  max_size normalized words to their id, so sentences and words that repeat
+  are neither tokenized nor looked up again. Hits and misses of both caches
+  are counted. A max_size of 0 disables caching.
+  """
+
+  def __init__(self, vocabulary, max_size=10000, tokenizer=None,
+               normalize_digits=True):
+    self.vocabulary = vocabulary
+    self.max_size = max_size
+    self.tokenizer = tokenizer
+    self.normalize_digits = normalize_digits
+    self._sentences = collections.OrderedDict()
+    self._words = collections.OrderedDict()
+    self.sentence_hits = self.sentence_misses = 0
+    self.word_hits = self.word_misses = 0
+
+  def _remember(self, cache, key, value):
+    if self.max_size > 0:
+      cache[key] = value
+      if len(cache) > self.max_size:
+        cache.popitem(last=False)
+
+  def word_to_id(self, word):
+    """Id of an already normalized word, UNK_ID if it is not in the vocabulary."""
+    # Popping and re-inserting marks a hit as most recently used; Python 2
+    # has no OrderedDict.move_to_end.
+    token_id = self._words.pop(word, None)
+    if token_id is not None:
+      self.word_hits += 1
+      self._words[word] = token_id
+      return token_id
+    self.word_misses += 1
+    token_id = self.vocabulary.get(word, UNK_ID)
+    self._remember(self._words, word, token_id)
+    return token_id
+
+  def sentence_to_token_ids(self, sentence):
+    """Same as sentence_to_token_ids(sentence, vocabulary, ...)."""
+    token_ids = self._sentences.pop(sentence, None)
+    if token_ids is not None:
+      self.sentence_hits += 1
+      self._sentences[sentence] = token_ids
+      return list(token_ids)
+    self.sentence_misses += 1
+    if self.tokenizer:
+      words = self.tokenizer(sentence)
+      if self.normalize_digits:
+        words = [_DIGIT_RE.sub("0", w) for w in words]
+    else:
+      words = fast_tokenizer(sentence, self.normalize_digits)
+    token_ids = [self.word_to_id(w) for w in words]
+    self._remember(self._sentences, sentence, tuple(token_ids))
+    return token_ids
+
+  def stats(self):
+    """A one-line summary of the hit and miss counters."""
+    return ("sentences %d hits / %d misses, words %d hits / %d misses"
+            % (self.sentence_hits, self.sentence_misses,
+               self.word_hits, self.word_misses))
+
+
+def binary_token_ids_exist(ids_path):
+  """Whether all files of the binary token-ids corpus ids_path exist."""
+  return all(gfile.Exists(ids_path + suffix) for suffix in
+             (_TOKENS_SUFFIX, _OFFSETS_SUFFIX, _LENGTHS_SUFFIX))
+
+
+# The array.array typecode of int64 items; Python 2 has no "q".
+_INT64_TYPECODE = np.dtype(np.int64).char
+
+
+class BinaryTokenIdsWriter(object):
+  """Writes token-ids in the binary corpus format read by TokenIds.
+
+  A binary corpus at ids_path consists of three flat native-endian arrays:
+    ids_path.tokens: int32 token-ids of all sentences, each one followed by
+      an EOS_ID, so a target with its EOS appended is a plain slice too;
+    ids_path.offsets: int64 start of every sentence in the token array, plus
+      one trailing entry with the total array length;
+    ids_path.lengths: int32 number of tokens in every sentence (without EOS).
+  """
+
+  def __init__(self, ids_path, buffer_size=1 << 20):
+    self._tokens_file = open(ids_path + _TOKENS_SUFFIX, "wb")
+    self._offsets_file = open(ids_path + _OFFSETS_SUFFIX, "wb")
+    self._lengths_file = open(ids_path + _LENGTHS_SUFFIX, "wb")
+    self._buffer_size = buffer_size
+    self._tokens = array.array("i")
+    self._offsets = array.array(_INT64_TYPECODE, [0])
+    self._lengths = array.array("i")
+    self._end = 0
+
+  def write(self, token_ids):
+    """Appends one sentence, given as a sequence of token-ids."""
+    self._tokens.extend(token_ids)
+    self._tokens.append(EOS_ID)
+    self._lengths.append(len(token_ids))
+    self._end += len(token_ids) + 1
+    self._offsets.append(self._end)
+    if len(self._tokens) >= self._buffer_size:
+      self._flush()
+
+  def _flush(self):
+    self._tokens.tofile(self._tokens_file)
+    self._offsets.tofile(self._offsets_file)
+    self._lengths.tofile(self._lengths_file)
+    self._tokens = array.array("i")
+    self._offsets = array.array(_INT64_TYPECODE)
+    self._lengths = array.array("i")
+
+  def close(self):
+    self._flush()
+    for f in (self._tokens_file, self._offsets_file, self._lengths_file):
+      f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+def _memmap(path, dtype):
+  if os.path.getsize(path) == 0:
+    return np.zeros([0], dtype=dtype)  # np.memmap refuses empty files.
+  return np.memmap(path, dtype=dtype, mode="r")
+
+
+class TokenIds(object):
+  """Read-only view of a binary token-ids corpus written by BinaryTokenIdsWriter.
+
+  Opening is O(1): the arrays are memory-mapped and only paged in when used,
+  and every sentence is returned as a zero-copy int32 view into them.
+  """
+
+  def __init__(self, ids_path):
+    self.tokens = _memmap(ids_path + _TOKENS_SUFFIX, np.int32)
+    self.offsets = _memmap(ids_path + _OFFSETS_SUFFIX, np.int64)
+    self.lengths = _memmap(ids_path + _LENGTHS_SUFFIX, np.int32)
+
+  def __len__(self):
+    return len(self.lengths)
+
+  def __getitem__(self, i):
+    """Token-ids of the i-th sentence."""
+    start = self.offsets[i]
+    return self.tokens[start:start + self.lengths[i]]
+
+  def with_eos(self, i):
+    """Token-ids of the i-th sentence followed by EOS_ID."""
+    start = self.offsets[i]
+    return self.tokens[start:start + self.lengths[i] + 1]
+
+
+def iter_token_ids(ids_path, binary=False, append_eos=False):
+  """Lazily yields the token-ids of every sentence in a token-ids file.
+
+  Args:
+    ids_path: path to a token-ids file written by data_to_token_ids.
+    binary: Boolean; whether ids_path is in the binary corpus format.
+    append_eos: Boolean; if true, every sentence is followed by EOS_ID.
+
+  Yields:
+    Lists of token-ids, or int32 views into the memory-mapped corpus if
+    binary is set.
+  """
+  if binary:
+    token_ids = TokenIds(ids_path)
+    sentence = token_ids.with_eos if append_eos else token_ids.__getitem__
+    for i in xrange(len(token_ids)):
+      yield sentence(i)
+  else:
+    with gfile.GFile(ids_path, mode="r") as ids_file:
+      for line in ids_file:
+        ids = [int(x) for x in line.split()]
+        if append_eos:
+          ids.append(EOS_ID)
+        yield ids
+
+
+# The settings of a tokenize_pool worker, and the TokenIdCache it converts
+# sentences with for every vocabulary it was given.
+_worker_settings = None
+_worker_token_id_caches = {}
+
+
+def _init_tokenize_worker(tokenizer, normalize_digits, cache_size):
+  global _worker_settings
+  _worker_settings = (tokenizer, normalize_digits, cache_size)
+
+
+def _tokenize_chunk(args):
+  vocabulary_path, lines = args
+  token_id_cache = _worker_token_id_caches.get(vocabulary_path)
+  if token_id_cache is None:
+    vocab, _ = initialize_vocabulary(vocabulary_path)
+    tokenizer, normalize_digits, cache_size = _worker_settings
+    token_id_cache = TokenIdCache(vocab, cache_size, tokenizer,
+                                  normalize_digits)
+    _worker_token_id_caches[vocabulary_path] = token_id_cache
+  return [token_id_cache.sentence_to_token_ids(line) for line in lines]
+
+
+def tokenize_pool(num_workers, tokenizer=None, normalize_digits=True,
+                  cache_size=0):
+  """A process pool for data_to_token_ids to tokenize several files with.
+
+  Every worker loads a vocabulary the first time it tokenizes with it. The
+  caller terminates the pool when done.
+  """
+  return multiprocessing.Pool(
+      num_workers, _init_tokenize_worker,
+      (tokenizer, normalize_digits, cache_size))
+
+
+def _tokenize_parallel(lines, vocabulary_path, pool, num_workers,
+                       chunk_size=10000):
+  """Yields the token-ids of lines, tokenized in chunks by a tokenize_pool.
+
+  At most two chunks per worker are in flight at any time, and results are
+  yielded in the order of lines.
+  """
+  pending = collections.deque()
+  chunk = []
+  for line in lines:
+    chunk.append(line)
+    if len(chunk) == chunk_size:
+      pending.append(pool.apply_async(_tokenize_chunk,
+                                      ((vocabulary_path, chunk),)))
+      chunk = []
+      if len(pending) >= 2 * num_workers:
+        for token_ids in pending.popleft().get():
+          yield token_ids
+  if chunk:
+    pending.append(pool.apply_async(_tokenize_chunk,
+                                    ((vocabulary_path, chunk),)))
+  while pending:
+    for token_ids in pending.popleft().get():
+      yield token_ids
+
+
 def data_to_token_ids(data_path, target_path, vocabulary_path,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True, binary=False,
+                      num_workers=1, cache_size=0, pool=None):
   """Tokenize data file and turn into token-ids using given vocabulary file.
 
   This function loads data line-by-line from data_path, calls the above
@@ -193,30 +723,202 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
   for sentence_to_token_ids on the details of token-ids format.
 
   Args:
-    data_path: path to the data file in one-sentence-per-line format.
+    data_path: path to the data file in one-sentence-per-line format; may be
+      compressed, see open_text_stream.
     target_path: path where the file with token-ids will be created.
     vocabulary_path: path to the vocabulary file.
     tokenizer: a function to use to tokenize each sentence;
       if None, basic_tokenizer will be used.
     normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    binary: Boolean; if true, target_path is written in the binary corpus
+      format of BinaryTokenIdsWriter instead of as text.
+    num_workers: number of processes tokenizing chunks of lines; the output
+      keeps the line order for any number.
+    cache_size: size of the TokenIdCache used by every tokenizing process.
+    pool: if given, a tokenize_pool of num_workers processes made with the
+      same tokenizer, normalize_digits and cache_size, which is used instead
+      of a pool of its own.
   """
-  if not gfile.Exists(target_path):
-    print("Tokenizing data in %s" % data_path)
-    vocab, _ = initialize_vocabulary(vocabulary_path)
-    with gfile.GFile(data_path, mode="r") as data_file:
-      with gfile.GFile(target_path, mode="w") as tokens_file:
+  if binary:
+    if binary_token_ids_exist(target_path):
+      return
+  elif gfile.Exists(target_path):
+    return
+  print("Tokenizing data in %s" % data_path)
+  start_time = time.time()
+  own_pool = None
+  if pool is None and num_workers > 1:
+    pool = own_pool = tokenize_pool(num_workers, tokenizer, normalize_digits,
+                                    cache_size)
+  try:
+    with open_text_stream(data_path) as data_file:
+      token_id_cache = None
+      if pool is not None:
+        all_token_ids = _tokenize_parallel(data_file, vocabulary_path, pool,
+                                           num_workers)
+      else:
+        vocab, _ = initialize_vocabulary(vocabulary_path)
+        token_id_cache = TokenIdCache(vocab, cache_size, tokenizer,
+                                      normalize_digits)
+        all_token_ids = (token_id_cache.sentence_to_token_ids(line)
+                         for line in data_file)
+      if binary:
+        tokens_file = BinaryTokenIdsWriter(target_path)
+      else:
+        tokens_file = gfile.GFile(target_path, mode="w")
+      with tokens_file:
         counter = 0
-        for line in data_file:
+        for token_ids in all_token_ids:
           counter += 1
           if counter % 100000 == 0:
             print("  tokenizing line %d" % counter)
-          token_ids = sentence_to_token_ids(line, vocab, tokenizer,
-                                            normalize_digits)
-          tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
+          if binary:
+            tokens_file.write(token_ids)
+          else:
+            tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
+  finally:
+    if own_pool is not None:
+      own_pool.terminate()
+      own_pool.join()
+  elapsed = max(time.time() - start_time, 1e-6)
+  print("  tokenized %d lines of %s in %.1fs (%.0f lines/sec)"
+        % (counter, data_path, elapsed, counter / elapsed))
+  if token_id_cache and cache_size > 0:
+    print("  token-id cache: %s" % token_id_cache.stats())
+
+
+def _sha1(path):
+  sha1 = hashlib.sha1()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      sha1.update(block)
+  return sha1.hexdigest()
+
+
+class PreprocessManifest(object):
+  """Records how every preprocessed artifact was made, to rebuild stale ones only.
+
+  The manifest is a JSON file that maps every artifact to the size, mtime and
+  SHA-1 of each of its input files and to the parameters it was built with.
+  An artifact is fresh if all of its output files exist and both still match.
+  Outputs that have no entry, such as those of a data_dir prepared before the
+  manifest, are stale: what they were built from is unknown, so they are
+  rebuilt once to record it.
+  Inputs whose size and mtime did not change are not hashed again, so
+  checking an unchanged artifact is instant; a touched but unchanged input
+  is recognized by its hash. The file is only rewritten when an entry
+  changed, and atomically, so processes sharing a data_dir always read a
+  complete manifest.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._artifacts = {}
+    self._changed = False
+    if gfile.Exists(path):
+      with gfile.GFile(path, mode="r") as f:
+        self._artifacts = json.load(f)
+    self._lock = threading.Lock()
+
+  def _fingerprint(self, input_path, recorded=None):
+    # Members of an archive are fingerprinted by the archive.
+    input_path = _stream_file(input_path)
+    stat = os.stat(input_path)
+    if (recorded and recorded["size"] == stat.st_size and
+        recorded["mtime"] == stat.st_mtime):
+      return recorded
+    return {"size": stat.st_size, "mtime": stat.st_mtime,
+            "sha1": _sha1(input_path)}
+
+  def is_fresh(self, outputs, inputs, params):
+    """Whether outputs exist and were built from the current inputs and params."""
+    with self._lock:
+      artifact = self._artifacts.get(outputs[0])
+    if (artifact is None or artifact["params"] != params or
+        sorted(artifact["inputs"]) != sorted(inputs) or
+        not all(gfile.Exists(output) for output in outputs)):
+      return False
+    for input_path in inputs:
+      recorded = artifact["inputs"][input_path]
+      fingerprint = self._fingerprint(input_path, recorded)
+      if fingerprint["sha1"] != recorded["sha1"]:
+        return False
+      if fingerprint is not recorded:
+        # Remember a new mtime of same contents.
+        with self._lock:
+          recorded.update(fingerprint)
+          self._changed = True
+    return True
+
+  def record(self, outputs, inputs, params):
+    """Records that outputs were just built from inputs with params."""
+    fingerprints = dict((input_path, self._fingerprint(input_path))
+                        for input_path in inputs)
+    with self._lock:
+      self._artifacts[outputs[0]] = {"outputs": outputs,
+                                     "inputs": fingerprints,
+                                     "params": params}
+      self._changed = True
+
+  def save(self):
+    """Writes the manifest if an entry changed since it was read or saved."""
+    with self._lock:
+      if not self._changed:
+        return
+      tmp_path = "%s.tmp%d" % (self.path, os.getpid())
+      with open(tmp_path, "w") as f:
+        json.dump(self._artifacts, f, indent=2, sort_keys=True)
+      os.rename(tmp_path, self.path)
+      self._changed = False
+
+
+def _is_fresh(manifest, outputs, inputs, params):
+  """Whether manifest says outputs are fresh; reports those that are."""
+  if manifest.is_fresh(outputs, inputs, params):
+    print("Skipping up-to-date %s" % outputs[0])
+    manifest.save()  # Keeps the mtimes of touched but unchanged inputs.
+    return True
+  return False
+
+
+def _rebuild(manifest, outputs, inputs, params, build):
+  """Removes outputs, runs build() and records them in manifest."""
+  for output in outputs:
+    if gfile.Exists(output):
+      gfile.Remove(output)
+  build()
+  manifest.record(outputs, inputs, params)
+  manifest.save()
+
+
+def _build_if_stale(manifest, outputs, inputs, params, build):
+  """Runs build() unless manifest says outputs are fresh; returns whether it ran."""
+  if _is_fresh(manifest, outputs, inputs, params):
+    return False
+  _rebuild(manifest, outputs, inputs, params, build)
+  return True
+
+
+def _token_ids_paths(ids_path, binary):
+  if binary:
+    return [ids_path + suffix
+            for suffix in (_TOKENS_SUFFIX, _OFFSETS_SUFFIX, _LENGTHS_SUFFIX)]
+  return [ids_path]
+
+
+def _find_text_input(data_dir, name, archive):
+  """Path of the text input name, as read by open_text_stream."""
+  if archive:
+    return archive + "#" + name
+  path = os.path.join(data_dir, name)
+  if not gfile.Exists(path) and gfile.Exists(path + ".gz"):
+    return path + ".gz"
+  return path
 
 
 def prepare_wmt_data(data_dir, en_vocabulary_size, fr_vocabulary_size,
-        load_embeddings=False, tokenizer=None):
+        load_embeddings=False, tokenizer=None, binary=False, num_workers=1,
+        cache_size=0, archive=None, prepare=True):
   """Get WMT data into data_dir, create vocabularies and tokenize data.
 
   Args:
@@ -225,6 +927,17 @@ def prepare_wmt_data(data_dir, en_vocabulary_size, fr_vocabulary_size,
     fr_vocabulary_size: size of the French vocabulary to create and use.
     tokenizer: a function to use to tokenize each data sentence;
       if None, basic_tokenizer will be used.
+    binary: Boolean; if true, token-ids are written in the binary corpus
+      format (see BinaryTokenIdsWriter) and the returned token-ids paths
+      must be opened with TokenIds.
+    num_workers: number of processes used for preprocessing.
+    cache_size: size of the TokenIdCache used while tokenizing.
+    archive: if set, the path of a tar archive holding the text inputs
+      train.txt.in, train.txt.out, dev.txt.in and dev.txt.out, which are then
+      streamed from it. Otherwise they are read from data_dir, or from their
+      gzipped versions if only those exist.
+    prepare: if False, nothing is read or written and only the paths are
+      returned, for readers of data another process prepares.
 
   Returns:
     A tuple of 6 elements:
@@ -238,33 +951,90 @@ def prepare_wmt_data(data_dir, en_vocabulary_size, fr_vocabulary_size,
   # Get wmt data to the specified directory.
   train_path = os.path.join(data_dir, "train.txt")
   dev_path = os.path.join(data_dir, "dev.txt")
+  en_train_input = _find_text_input(data_dir, "train.txt.in", archive)
+  fr_train_input = _find_text_input(data_dir, "train.txt.out", archive)
+  en_dev_input = _find_text_input(data_dir, "dev.txt.in", archive)
+  fr_dev_input = _find_text_input(data_dir, "dev.txt.out", archive)
 
-  # Create vocabularies of the appropriate sizes.
   fr_vocab_path = os.path.join(data_dir, "vocab%d.out" % fr_vocabulary_size)
   en_vocab_path = os.path.join(data_dir, "vocab%d.in" % en_vocabulary_size)
-  create_vocabulary(fr_vocab_path, train_path + ".out", fr_vocabulary_size,
-          os.path.join(data_dir, "dec_embedding{0}.tsv".format(fr_vocabulary_size)),
-          tokenizer)
-  create_vocabulary(en_vocab_path, train_path + ".in", en_vocabulary_size,
-          os.path.join(data_dir, "enc_embedding{0}.tsv".format(en_vocabulary_size)),
-          tokenizer)
+  fr_train_ids_path = train_path + (".ids%d.out" % fr_vocabulary_size)
+  en_train_ids_path = train_path + (".ids%d.in" % en_vocabulary_size)
+  fr_dev_ids_path = dev_path + (".ids%d.out" % fr_vocabulary_size)
+  en_dev_ids_path = dev_path + (".ids%d.in" % en_vocabulary_size)
+  paths = (en_train_ids_path, fr_train_ids_path,
+           en_dev_ids_path, fr_dev_ids_path,
+           en_vocab_path, fr_vocab_path)
+  if not prepare:
+    return paths
+
+  # Every artifact is rebuilt if its inputs or settings changed since it was
+  # last built, as recorded in the manifest.
+  manifest = PreprocessManifest(os.path.join(data_dir, "manifest.json"))
+  tokenizer_params = {
+      "tokenizer": tokenizer.__name__ if tokenizer else "basic_tokenizer",
+      "normalize_digits": True,
+  }
+
+  # Create vocabularies of the appropriate sizes.
+  vocab_jobs = [
+      (fr_vocab_path, fr_train_input, fr_vocabulary_size,
+       os.path.join(data_dir, "dec_embedding{0}.tsv".format(fr_vocabulary_size))),
+      (en_vocab_path, en_train_input, en_vocabulary_size,
+       os.path.join(data_dir, "enc_embedding{0}.tsv".format(en_vocabulary_size)))]
+  for vocab_path, data_path, vocabulary_size, embedding_path in vocab_jobs:
+    params = dict(tokenizer_params, vocabulary_size=vocabulary_size)
+    _build_if_stale(
+        manifest, [vocab_path, embedding_path], [data_path], params,
+        lambda: create_vocabulary(vocab_path, data_path, vocabulary_size,
+                                  embedding_path, tokenizer,
+                                  num_workers=num_workers))
   #if load_embeddings:
   #  embed_utils.save_embeddings(fr_vocab_path, "embed5000.txt")
   #  embed_utils.save_embeddings(en_vocab_path, "embed5000.txt")
     
 
-  # Create token ids for the training data.
-  fr_train_ids_path = train_path + (".ids%d.out" % fr_vocabulary_size)
-  en_train_ids_path = train_path + (".ids%d.in" % en_vocabulary_size)
-  data_to_token_ids(train_path + ".out", fr_train_ids_path, fr_vocab_path, tokenizer)
-  data_to_token_ids(train_path + ".in", en_train_ids_path, en_vocab_path, tokenizer)
-
-  # Create token ids for the development data.
-  fr_dev_ids_path = dev_path + (".ids%d.out" % fr_vocabulary_size)
-  en_dev_ids_path = dev_path + (".ids%d.in" % en_vocabulary_size)
-  data_to_token_ids(dev_path + ".out", fr_dev_ids_path, fr_vocab_path, tokenizer)
-  data_to_token_ids(dev_path + ".in", en_dev_ids_path, en_vocab_path, tokenizer)
+  # Create token ids for the training and development data. With several
+  # workers the stale files are tokenized concurrently, each on a thread of
+  # its own that feeds its chunks to a single pool, which is only made when
+  # some file needs tokenizing.
+  params = dict(tokenizer_params, binary=binary)
+  jobs = [(fr_train_input, fr_train_ids_path, fr_vocab_path),
+          (en_train_input, en_train_ids_path, en_vocab_path),
+          (fr_dev_input, fr_dev_ids_path, fr_vocab_path),
+          (en_dev_input, en_dev_ids_path, en_vocab_path)]
+  stale_jobs = [(data_path, ids_path, vocab_path)
+                for data_path, ids_path, vocab_path in jobs
+                if not _is_fresh(manifest, _token_ids_paths(ids_path, binary),
+                                 [data_path, vocab_path], params)]
+  if not stale_jobs:
+    return paths
+  pool = threads = None
+  if num_workers > 1:
+    # The pool is forked before any thread is started.
+    pool = tokenize_pool(num_workers, tokenizer, cache_size=cache_size)
+    threads = multiprocessing.pool.ThreadPool(len(stale_jobs))
+  try:
+    results = []
+    for data_path, ids_path, vocab_path in stale_jobs:
+      build = functools.partial(
+          data_to_token_ids, data_path, ids_path, vocab_path, tokenizer,
+          binary=binary, num_workers=num_workers, cache_size=cache_size,
+          pool=pool)
+      args = (manifest, _token_ids_paths(ids_path, binary),
+              [data_path, vocab_path], params, build)
+      if threads is not None:
+        results.append(threads.apply_async(_rebuild, args))
+      else:
+        _rebuild(*args)
+    for result in results:
+      result.get()
+  finally:
+    if threads is not None:
+      threads.close()
+      threads.join()
+    if pool is not None:
+      pool.terminate()
+      pool.join()
 
-  return (en_train_ids_path, fr_train_ids_path,
-          en_dev_ids_path, fr_dev_ids_path,
-          en_vocab_path, fr_vocab_path)
+  return paths
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Tokenizers of the data pipeline; they do not depend on TensorFlow.
+
+Check that fast_tokenizer matches basic_tokenizer on some text files with
+  python -m utils.tokenizer_utils corpus/test.txt.in
+and on corner cases with
+  python -m unittest utils.tokenizer_utils_test
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import re
+import sys
+
+# Regular expressions used to tokenize.
+_WORD_SPLIT = re.compile("([.,!?\"':;)(])")
+_DIGIT_RE = re.compile(r"\d")
+# The tokens basic_tokenizer finds: every _WORD_SPLIT character on its own and
+# every maximal run of characters that are neither whitespace nor one of them.
+# Whitespace is what str.split() splits on: any Unicode whitespace in text,
+# and only ASCII whitespace in byte strings, as which Python 2 reads files.
+_TOKEN_RE = re.compile(r"[.,!?\"':;)(]|[^\s.,!?\"':;)(]+", re.UNICODE)
+_BYTES_TOKEN_RE = re.compile(br"[.,!?\"':;)(]|[^\s.,!?\"':;)(]+")
+
+
+def basic_tokenizer(sentence):
+  """Very basic tokenizer: split the sentence into a list of tokens."""
+  words = []
+  for space_separated_fragment in sentence.strip().split():
+    words.extend(_WORD_SPLIT.split(space_separated_fragment))
+  return [w for w in words if w]
+
+
+def fast_tokenizer(sentence, normalize_digits=False):
+  """Tokenize like basic_tokenizer, optionally normalizing digits on the way.
+
+  The tokens are found with a single regular expression scan of the sentence,
+  and digits are replaced by 0s with one substitution over the whole sentence
+  instead of one per token; digits are never split characters, so the result
+  is the same as normalizing every token of basic_tokenizer afterwards.
+  """
+  if normalize_digits:
+    sentence = _DIGIT_RE.sub("0", sentence)
+  if isinstance(sentence, bytes):
+    return _BYTES_TOKEN_RE.findall(sentence)
+  return _TOKEN_RE.findall(sentence)
+
+
+def check_fast_tokenizer(lines):
+  """Checks that fast_tokenizer agrees with basic_tokenizer.
+
+  Both are compared with and without digit normalization on every line.
+
+  Args:
+    lines: iterable of sentences.
+
+  Returns:
+    the number of sentences checked.
+
+  Raises:
+    AssertionError: if the tokenizers disagree on any sentence.
+  """
+  num_lines = 0
+  for line in lines:
+    for normalize_digits in (False, True):
+      expected = basic_tokenizer(line)
+      if normalize_digits:
+        expected = [_DIGIT_RE.sub("0", w) for w in expected]
+      actual = fast_tokenizer(line, normalize_digits)
+      if actual != expected:
+        raise AssertionError("Tokenizers disagree on %r: %r != %r"
+                             % (line, actual, expected))
+    num_lines += 1
+  return num_lines
+
+
+def main(paths):
+  lines = []
+  for path in paths:
+    with io.open(path, encoding="utf-8") as f:
+      lines.extend(f)
+  print("fast_tokenizer matches basic_tokenizer on %d lines."
+        % check_fast_tokenizer(lines))
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Tests for utils.tokenizer_utils; run with
+  python -m unittest utils.tokenizer_utils_test
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+from utils import tokenizer_utils
+
+# Lines exercising the corners of the tokenizers.
+_TOKENIZER_CASES = [
+    u"",
+    u"   \t  \n",
+    u"Hello, world!",
+    u"(a)b\"c'd:e;f?g.h",
+    u"...!!",
+    u"tel. 555-1234 at 9:30am",
+    u"\u0663\u0664 digits \uff11\uff12 and \xb2 superscripts",
+    u"no\xa0break space\u3000ideographic",
+    u"trailing punct )",
+]
+
+
+class FastTokenizerTest(unittest.TestCase):
+
+  def testMatchesBasicTokenizer(self):
+    self.assertEqual(len(_TOKENIZER_CASES),
+                     tokenizer_utils.check_fast_tokenizer(_TOKENIZER_CASES))
+
+  def testSplitsOnUnicodeWhitespace(self):
+    self.assertEqual([u"no", u"break", u"space", u"ideographic"],
+                     tokenizer_utils.fast_tokenizer(
+                         u"no\xa0break space\u3000ideographic"))
+
+  def testSplitsByteStringsOnAsciiWhitespaceOnly(self):
+    # The UTF-8 encoding of "à" ends in the byte of a no-break space.
+    self.assertEqual([b"voil\xc3\xa0", b"!"],
+                     tokenizer_utils.fast_tokenizer(b"voil\xc3\xa0 !"))
+
+
+if __name__ == "__main__":
+  unittest.main()
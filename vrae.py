@@ -37,20 +37,32 @@ import sys
 import time
 import logging
 import json
+import collections
+import contextlib
+import hashlib
+import inspect
+import re
+import subprocess
 
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
 import utils.data_utils as data_utils
+import utils.batch_utils as batch_utils
+import utils.bucket_utils as bucket_utils
 import seq2seq_model
 from tensorflow.python.platform import gfile
 
 tf.app.flags.DEFINE_string("model_dir", "models", "directory of the model.")
 tf.app.flags.DEFINE_boolean("new", True, "whether this is a new model or not.")
-tf.app.flags.DEFINE_string("do", "train", "what to do. accepts train, interpolate, sample, and decode.")
+tf.app.flags.DEFINE_string("do", "train", "what to do. accepts train, interpolate, sample, reconstruct, plan_buckets, autotune and export.")
 tf.app.flags.DEFINE_string("input", None, "input filename for reconstruct sample, and interpolate.")
 tf.app.flags.DEFINE_string("output", None, "output filename for reconstruct sample, and interpolate.")
+tf.app.flags.DEFINE_string("frozen_graph", None, "graph written by export, to reconstruct, sample and interpolate with instead of the checkpoint.")
+tf.app.flags.DEFINE_string("job_name", "", "ps or worker, to run one task of the cluster in config.json; empty for local training.")
+tf.app.flags.DEFINE_integer("task_index", 0, "index of the task within its job.")
+tf.app.flags.DEFINE_string("probe", "", "session settings, as JSON, for autotune to time in this process; set by autotune itself.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -64,7 +76,8 @@ def prelu(x):
 # See seq2seq_model.Seq2SeqModel for details of how they work.
 
 
-def read_data(source_path, target_path, config, max_size=None):
+def read_data(source_path, target_path, config, max_size=None, shard_index=0,
+              num_shards=1):
   """Read data from source and target files and put into buckets.
 
   Args:
@@ -74,6 +87,18 @@ def read_data(source_path, target_path, config, max_size=None):
       output for n-th line from the source_path.
     max_size: maximum number of lines to read, all other will be ignored;
       if 0 or None, data files will be read completely (no limit).
+    shard_index, num_shards: only every num_shards-th line, starting with line
+      shard_index, is kept, so that num_shards readers get disjoint shards
+      of the first max_size lines.
+
+  If config.binary_ids is set, both paths are binary token-ids corpora (see
+  data_utils.TokenIds); they are memory-mapped, every data_set[n] is a
+  batch_utils.TokenIdsBucket of the indices of its sentence pairs, and
+  source and target are zero-copy int32 views into them instead of lists.
+  If config.compact_buckets is set, every data_set[n] is a frozen
+  batch_utils.CompactBucket instead, filled while reading (or gathered from
+  the binary corpora at once, which copies them into memory), and its memory
+  is reported next to that of the same examples as lists.
 
   Returns:
     data_set: a list of length len(config.buckets); data_set[n] contains a list of
@@ -82,6 +107,31 @@ def read_data(source_path, target_path, config, max_size=None):
       len(target) < config.buckets[n][1]; source and target are lists of token-ids.
   """
   data_set = [[] for _ in config.buckets]
+  if config.compact_buckets:
+    data_set = [batch_utils.CompactBucket(dedup=config.dedup_examples)
+                for _ in config.buckets]
+  if config.binary_ids:
+    sources = data_utils.TokenIds(source_path)
+    targets = data_utils.TokenIds(target_path)
+    size = min(len(sources), len(targets))
+    if max_size:
+      size = min(size, max_size)
+    source_lengths = sources.lengths[:size]
+    target_lengths = targets.lengths[:size] + 1  # Targets get an EOS_ID.
+    unassigned = np.arange(size) % num_shards == shard_index
+    for bucket_id, (source_size, target_size) in enumerate(config.buckets):
+      fits = (unassigned & (source_lengths < source_size) &
+              (target_lengths < target_size))
+      unassigned &= ~fits
+      if config.compact_buckets:
+        data_set[bucket_id] = batch_utils.CompactBucket.from_token_ids(
+            sources, targets, np.flatnonzero(fits), config.dedup_examples)
+      else:
+        data_set[bucket_id] = batch_utils.TokenIdsBucket(
+            sources, targets, np.flatnonzero(fits))
+    if config.compact_buckets:
+      _print_bucket_storage(data_set)
+    return data_set
   with tf.gfile.GFile(source_path, mode="r") as source_file:
     with tf.gfile.GFile(target_path, mode="r") as target_file:
       source, target = source_file.readline(), target_file.readline()
@@ -91,22 +141,110 @@ def read_data(source_path, target_path, config, max_size=None):
         if counter % 100000 == 0:
           print("  reading data line %d" % counter)
           sys.stdout.flush()
+        if (counter - 1) % num_shards != shard_index:
+          source, target = source_file.readline(), target_file.readline()
+          continue
         source_ids = [int(x) for x in source.split()]
         target_ids = [int(x) for x in target.split()]
         target_ids.append(data_utils.EOS_ID)
         for bucket_id, (source_size, target_size) in enumerate(config.buckets):
           if len(source_ids) < source_size and len(target_ids) < target_size:
-            data_set[bucket_id].append([source_ids, target_ids])
+            if config.compact_buckets:
+              data_set[bucket_id].append(source_ids, target_ids)
+            else:
+              data_set[bucket_id].append([source_ids, target_ids])
             break
         source, target = source_file.readline(), target_file.readline()
+  if config.compact_buckets:
+    for bucket in data_set:
+      bucket.freeze()
+    _print_bucket_storage(data_set)
   return data_set
 
 
-def create_model(session, config, forward_only):
-  """Create translation model and initialize or load parameters in session."""
+def _print_bucket_storage(data_set):
+  print("  bucket storage: %.1f MB (%.1f MB as lists)" %
+        (sum(b.nbytes for b in data_set) / float(1 << 20),
+         sum(b.list_nbytes() for b in data_set) / float(1 << 20)))
+
+
+def make_session_config(config, **kwargs):
+  """A tf.ConfigProto with the threads and graph options of config.
+
+  The thread pools are shared by all sessions of a process and sized by the
+  first one, so the thread counts only take effect in a process's first
+  session. kwargs, e.g. device_count, are passed on to tf.ConfigProto.
+  """
+  return tf.ConfigProto(
+      intra_op_parallelism_threads=config.intra_op_parallelism_threads,
+      inter_op_parallelism_threads=config.inter_op_parallelism_threads,
+      graph_options=tf.GraphOptions(optimizer_options=tf.OptimizerOptions(
+          opt_level=getattr(tf.OptimizerOptions, config.opt_level))),
+      **kwargs)
+
+
+# Settings the graph of the model depends on; see _graph_cache_key.
+_GRAPH_SETTINGS = [
+    "en_vocab_size", "fr_vocab_size", "buckets", "size", "num_layers",
+    "latent_dim", "max_gradient_norm", "batch_size", "learning_rate", "kl_min",
+    "word_dropout_keep_prob", "anneal", "use_lstm", "feed_previous",
+    "bidirectional", "orthogonal_initializer", "iaf", "activation",
+    "dynamic_encoder", "single_graph", "fused_loss", "cell_backend",
+    "num_towers", "accumulate_steps"]
+
+
+def _graph_cache_key(config, forward_only):
+  """Hash of everything the graph built for config depends on.
+
+  Besides the settings, this is the TensorFlow version and the source of the
+  modules that build the graph, so changes to the code miss the cache too.
+  """
+  settings = dict((name, getattr(config, name, None))
+                  for name in _GRAPH_SETTINGS)
+  settings["forward_only"] = forward_only
+  digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8"))
+  digest.update(tf.__version__.encode("utf-8"))
+  for module in (sys.modules[__name__], seq2seq_model, seq2seq_model.seq2seq):
+    digest.update(inspect.getsource(module).encode("utf-8"))
+  return digest.hexdigest()
+
+
+def _build_model(config, forward_only, optimizer=None):
+  """Build the model graph, or import it from config.graph_cache.
+
+  Cached graphs are written with their Adam optimizer, so a graph is only
+  cached or imported if optimizer is not given.
+  """
+  if not config.graph_cache or optimizer is not None:
+    return _new_model(config, forward_only, optimizer)
+  meta_graph_path = os.path.join(
+      config.graph_cache, _graph_cache_key(config, forward_only) + ".meta")
+  start_time = time.time()
+  if gfile.Exists(meta_graph_path + ".json"):
+    model = seq2seq_model.Seq2SeqModel.from_meta_graph(meta_graph_path)
+    print("Imported cached graph %s in %.2f s."
+          % (meta_graph_path, time.time() - start_time))
+    return model
+
+  model = _new_model(config, forward_only)
+  cold_time = time.time() - start_time
+  if not gfile.Exists(config.graph_cache):
+    gfile.MakeDirs(config.graph_cache)
+  model.export_meta_graph(meta_graph_path)
+  # Time an import of the cached graph, to report what later runs take.
+  start_time = time.time()
+  with tf.Graph().as_default():
+    seq2seq_model.Seq2SeqModel.from_meta_graph(meta_graph_path)
+  warm_time = time.time() - start_time
+  print("Built graph in %.2f s and cached it as %s; importing it takes %.2f s."
+        % (cold_time, meta_graph_path, warm_time))
+  return model
+
+
+def _new_model(config, forward_only, optimizer=None):
+  """Build the model graph; training uses Adam unless optimizer is given."""
   dtype = tf.float32
-  optimizer = None
-  if not forward_only:
+  if optimizer is None and not forward_only:
     optimizer = tf.train.AdamOptimizer(config.learning_rate)
   if config.activation == "elu":
     activation = tf.nn.elu
@@ -131,7 +269,8 @@ def create_model(session, config, forward_only):
       config.kl_min,
       config.word_dropout_keep_prob,
       config.anneal,
-      config.use_lstm,
+      kl_rate_rise_factor=config.kl_rate_rise_factor,
+      use_lstm=config.use_lstm,
       optimizer=optimizer,
       activation=activation,
       forward_only=forward_only,
@@ -140,98 +279,366 @@ def create_model(session, config, forward_only):
       weight_initializer=weight_initializer,
       bias_initializer=bias_initializer,
       iaf=config.iaf,
+      dynamic_encoder=config.dynamic_encoder,
+      single_graph=config.single_graph,
+      fused_loss=config.fused_loss,
+      cell_backend=config.cell_backend,
+      num_towers=config.num_towers,
+      accumulate_steps=config.accumulate_steps,
       dtype=dtype)
+  return model
+
+
+def _restore_model(session, model):
+  """Load the latest checkpoint in model_dir unless --new; True if loaded."""
   ckpt = tf.train.get_checkpoint_state(FLAGS.model_dir)
   if not FLAGS.new and ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
     print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-    model.saver.restore(session, ckpt.model_checkpoint_path)
-  else:
+    model.restore(session, ckpt.model_checkpoint_path)
+    return True
+  return False
+
+
+def create_model(session, config, forward_only):
+  """Create translation model and initialize or load parameters in session."""
+  model = _build_model(config, forward_only)
+  if not _restore_model(session, model):
     print("Created model with fresh parameters.")
     session.run(tf.global_variables_initializer())
+  # Accumulated gradients are not saved; accumulation starts afresh.
+  if model.accumulator_init is not None:
+    session.run(model.accumulator_init)
   return model
 
 
-def train(config):
-  """Train a en->fr translation model using WMT data."""
-  # Prepare WMT data.
-  print("Preparing WMT data in %s" % config.data_dir)
-  en_train, fr_train, en_dev, fr_dev, _, _ = data_utils.prepare_wmt_data(
-      config.data_dir, config.en_vocab_size, config.fr_vocab_size, config.load_embeddings)
+def load_inference_model(session, config):
+  """The forward-only model, from --frozen_graph if given, else a checkpoint."""
+  if not FLAGS.frozen_graph:
+    return create_model(session, config, True)
+  print("Reading frozen graph from %s" % FLAGS.frozen_graph)
+  model = seq2seq_model.FrozenModel(FLAGS.frozen_graph)
+  if model.buckets != [tuple(bucket) for bucket in config.buckets]:
+    raise ValueError("Buckets of the frozen graph %s differ from those in "
+                     "config.json %s." % (model.buckets, config.buckets))
+  return model
+
+
+def export(sess, model, config):
+  """Write the model as a frozen inference graph, to --output if given."""
+  export_path = FLAGS.output or os.path.join(FLAGS.model_dir, "frozen_graph.pb")
+  graph_def = seq2seq_model.export_inference_graph(sess, model, export_path)
+  print("Wrote frozen graph of %d nodes (%.1f MB) to %s."
+        % (len(graph_def.node), graph_def.ByteSize() / float(1 << 20),
+           export_path))
+
+
+def _sampler_path(checkpoint_file):
+  return checkpoint_file + ".sampler.npz"
+
+
+def _save_sampler(batcher, position, checkpoint_file):
+  """Saves the sampler state next to a checkpoint.
+
+  States of checkpoints the saver has deleted in the meantime are removed.
+  """
+  batcher.save(_sampler_path(checkpoint_file), position)
+  for path in gfile.Glob(_sampler_path(os.path.join(
+      os.path.dirname(checkpoint_file), "*"))):
+    if not tf.train.checkpoint_exists(path[:-len(_sampler_path(""))]):
+      gfile.Remove(path)
+
+
+def _cluster(config):
+  return tf.train.ClusterSpec({"ps": config.ps_hosts,
+                              "worker": config.worker_hosts})
+
+
+def run_parameter_server(config):
+  """Serve the variables of the cluster as parameter server --task_index."""
+  server = tf.train.Server(_cluster(config), job_name="ps",
+                           task_index=FLAGS.task_index,
+                           config=make_session_config(config))
+  server.join()
+
 
-  with tf.Session() as sess:
-    if not os.path.exists(FLAGS.model_dir):
-      os.makedirs(FLAGS.model_dir)
+def launch_local(config):
+  """Run every task of the cluster in config as a process on this machine.
 
-    # Create model.
-    print("Creating %d layers of %d units." % (config.num_layers, config.size))
-    model = create_model(sess, config, False)
+  The data is prepared once up front; of the workers only the chief checks
+  it again, see train. Returns once any task has exited, after stopping all
+  the others.
+  """
+  print("Preparing WMT data in %s" % config.data_dir)
+  data_utils.prepare_wmt_data(
+      config.data_dir, config.en_vocab_size, config.fr_vocab_size, config.load_embeddings,
+      binary=config.binary_ids, num_workers=config.preprocess_workers,
+      cache_size=config.token_cache_size, archive=config.data_archive)
+  tasks = ([("ps", i) for i in xrange(len(config.ps_hosts))] +
+           [("worker", i) for i in xrange(len(config.worker_hosts))])
+  processes = []
+  try:
+    for job_name, task_index in tasks:
+      print("Starting %s task %d." % (job_name, task_index))
+      processes.append(subprocess.Popen(
+          [sys.executable] + sys.argv +
+          ["--job_name=%s" % job_name, "--task_index=%d" % task_index]))
+    while all(process.poll() is None for process in processes):
+      time.sleep(1)
+  finally:
+    for process in processes:
+      if process.poll() is None:
+        process.terminate()
+    for process in processes:
+      process.wait()
+  for (job_name, task_index), process in zip(tasks, processes):
+    print("%s task %d exited with code %d."
+          % (job_name, task_index, process.returncode))
+
+
+@contextlib.contextmanager
+def _train_session(config):
+  """Yield (session, model, is_chief) to train the model with.
+
+  Without --job_name, the model is trained in a session of this process.
+  With --job_name worker, this process is worker --task_index of the cluster
+  in config: the variables live on the parameter servers, the first worker is
+  the chief, which initializes or restores them, and every worker applies its
+  updates asynchronously, or, with config.sync_replicas, each update applies
+  the aggregated gradients of one step of all workers.
+  """
+  if not FLAGS.job_name:
+    # Every tower runs on a CPU device of its own. The devices share one
+    # intra-op thread pool; TensorFlow has no thread pool per device.
+    session_config = make_session_config(
+        config, device_count={"CPU": config.num_towers})
+    with tf.Session(config=session_config) as sess:
+      yield sess, create_model(sess, config, False), True
+    return
+
+  if config.num_towers > 1:
+    raise ValueError("num_towers must be 1 in distributed training.")
+  if config.accumulate_steps > 1:
+    raise ValueError("accumulate_steps must be 1 in distributed training.")
+  if config.sync_replicas and not config.single_graph:
+    raise ValueError("sync_replicas requires single_graph, which has a single "
+                     "update op to aggregate the gradients of the workers in.")
+  num_workers = len(config.worker_hosts)
+  is_chief = FLAGS.task_index == 0
+  cluster = _cluster(config)
+  server = tf.train.Server(cluster, job_name="worker",
+                           task_index=FLAGS.task_index)
+  optimizer = tf.train.AdamOptimizer(config.learning_rate)
+  if config.sync_replicas:
+    optimizer = tf.train.SyncReplicasOptimizerV2(
+        optimizer, replicas_to_aggregate=num_workers,
+        total_num_replicas=num_workers)
+  with tf.device(tf.train.replica_device_setter(
+      worker_device="/job:worker/task:%d" % FLAGS.task_index,
+      cluster=cluster)):
+    model = _build_model(config, False, optimizer)
+    init_op = tf.global_variables_initializer()
+
+  local_init = {}
+  if config.sync_replicas:
+    local_init = {
+        "local_init_op": (optimizer.chief_init_op if is_chief
+                          else optimizer.local_step_init_op),
+        "ready_for_local_init_op": optimizer.ready_for_local_init_op}
+    chief_queue_runner = optimizer.get_chief_queue_runner()
+    sync_init_op = optimizer.get_init_tokens_op()
+  supervisor = tf.train.Supervisor(
+      is_chief=is_chief, init_op=init_op, saver=model.saver,
+      init_fn=lambda sess: _restore_model(sess, model),
+      global_step=model.global_step, recovery_wait_secs=1, **local_init)
+  session_config = make_session_config(config, device_filters=[
+      "/job:ps", "/job:worker/task:%d" % FLAGS.task_index])
+  with supervisor.managed_session(server.target,
+                                  config=session_config) as sess:
+    if config.sync_replicas and is_chief:
+      sess.run(sync_init_op)
+      supervisor.start_queue_runners(sess, [chief_queue_runner])
+    with sess.as_default():
+      yield sess, model, is_chief
 
+
+def train(config):
+  """Train a en->fr translation model using WMT data."""
+  # Prepare WMT data. Of the workers of a cluster only the chief does; the
+  # others only read it once their session is ready, and the chief
+  # initializes the model only after preparing the data.
+  prepare = not FLAGS.job_name or FLAGS.task_index == 0
+  if prepare:
+    print("Preparing WMT data in %s" % config.data_dir)
+  en_train, fr_train, en_dev, fr_dev, _, _ = data_utils.prepare_wmt_data(
+      config.data_dir, config.en_vocab_size, config.fr_vocab_size, config.load_embeddings,
+      binary=config.binary_ids, num_workers=config.preprocess_workers,
+      cache_size=config.token_cache_size, archive=config.data_archive,
+      prepare=prepare)
+
+  if not os.path.exists(FLAGS.model_dir):
+    os.makedirs(FLAGS.model_dir)
+  # A worker of a cluster trains on its own shard of the training data.
+  shard_index, num_shards = 0, 1
+  if FLAGS.job_name:
+    shard_index, num_shards = FLAGS.task_index, len(config.worker_hosts)
+
+  # Create model.
+  print("Creating %d layers of %d units." % (config.num_layers, config.size))
+  with _train_session(config) as (sess, model, is_chief):
     if not config.probabilistic:
       self.kl_rate_update(0.0)
 
-    train_writer = tf.summary.FileWriter(os.path.join(FLAGS.model_dir,"train"), graph=sess.graph)
-    dev_writer = tf.summary.FileWriter(os.path.join(FLAGS.model_dir, "test"), graph=sess.graph)
+    # Only the chief writes summaries and checkpoints and runs evals.
+    if is_chief:
+      train_writer = tf.summary.FileWriter(os.path.join(FLAGS.model_dir,"train"), graph=sess.graph)
+      dev_writer = tf.summary.FileWriter(os.path.join(FLAGS.model_dir, "test"), graph=sess.graph)
 
     # Read data into buckets and compute their sizes.
     print ("Reading development and training data (limit: %d)."
            % config.max_train_data_size)
 
     dev_set = read_data(en_dev, fr_dev, config)
-    train_set = read_data(en_train, fr_train, config, config.max_train_data_size)
-    train_bucket_sizes = [len(train_set[b]) for b in xrange(len(config.buckets))]
-    train_total_size = float(sum(train_bucket_sizes))
-
-    # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-    # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-    # the size if i-th training bucket, as used later.
-    train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                           for i in xrange(len(train_bucket_sizes))]
+    batcher = None
+    if config.streaming:
+      # Training data is streamed from disk instead of being read up front.
+      train_source = batch_utils.StreamingDataSource(
+          [en_train], [fr_train], config.buckets, config.batch_size,
+          config.shuffle_buffer_size, binary=config.binary_ids,
+          max_size=config.max_train_data_size, shard_index=shard_index,
+          num_shards=num_shards)
+
+      def sample_batch():
+        bucket_id, examples = train_source.next_batch()
+        return bucket_id, model.make_batch(examples, bucket_id), None
+    else:
+      train_set = read_data(en_train, fr_train, config, config.max_train_data_size,
+                            shard_index, num_shards)
+      if config.batching in ("epoch", "sorted"):
+        if config.batching == "sorted":
+          batcher = batch_utils.LengthSortedBatcher(
+              train_set, config.buckets, config.batch_size,
+              config.sort_chunk_batches)
+        else:
+          batcher = batch_utils.EpochSampler(
+              train_set, config.buckets, config.batch_size)
+        print("%s batching: %d batches per epoch."
+              % (config.batching.capitalize(), batcher.num_batches))
+        # Positions are saved for the whole training data only, not shards.
+        ckpt = tf.train.get_checkpoint_state(FLAGS.model_dir)
+        if not FLAGS.job_name and not FLAGS.new and ckpt and os.path.exists(
+            _sampler_path(ckpt.model_checkpoint_path)):
+          batcher.restore(_sampler_path(ckpt.model_checkpoint_path))
+          print("Resuming epoch %d from %s"
+                % (batcher.epoch, _sampler_path(ckpt.model_checkpoint_path)))
+
+        def sample_batch():
+          bucket_id, example_ids, position = batcher.next_batch()
+          return (bucket_id, model.get_batch(train_set, bucket_id, example_ids),
+                  position)
+      else:
+        train_bucket_sizes = [len(train_set[b]) for b in xrange(len(config.buckets))]
+        train_total_size = float(sum(train_bucket_sizes))
+
+        # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
+        # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
+        # the size if i-th training bucket, as used later.
+        train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
+                               for i in xrange(len(train_bucket_sizes))]
+
+        def sample_batch():
+          # Choose a bucket according to data distribution. We pick a random number
+          # in [0, 1] and use the corresponding interval in train_buckets_scale.
+          random_number_01 = np.random.random_sample()
+          bucket_id = min([i for i in xrange(len(train_buckets_scale))
+                           if train_buckets_scale[i] > random_number_01])
+          return bucket_id, model.get_batch(train_set, bucket_id), None
+
+    # Batches are built on background threads while the session runs. An
+    # epoch batcher hands out positions in order, and the saved position must
+    # cover exactly the batches trained on, so it gets a single producer.
+    if config.prefetch_queue_depth > 0:
+      prefetch_threads = 1 if batcher else config.prefetch_threads
+      next_batch = batch_utils.BatchPrefetcher(
+          sample_batch, config.prefetch_queue_depth, prefetch_threads).get
+    else:
+      next_batch = sample_batch
 
     # This is the training loop.
     step_time, loss = 0.0, 0.0
     KL_loss = 0.0
+    local_steps = 0
+    accumulated_steps = 0
     current_step = model.global_step.eval()
     step_loss_summaries = []
     step_KL_loss_summaries = []
     overall_start_time = time.time()
     while True:
-      # Choose a bucket according to data distribution. We pick a random number
-      # in [0, 1] and use the corresponding interval in train_buckets_scale.
-      random_number_01 = np.random.random_sample()
-      bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                       if train_buckets_scale[i] > random_number_01])
-
       # Get a batch and make a step.
       start_time = time.time()
-      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-          train_set, bucket_id)
+      bucket_id, (encoder_inputs, decoder_inputs, target_weights), position = (
+          next_batch())
+      # The last step before a checkpoint is traced for per-tower timing.
+      run_metadata = None
+      if (config.num_towers > 1 and
+          (current_step + 1) % config.steps_per_checkpoint == 0):
+        run_metadata = tf.RunMetadata()
       _, step_loss, step_KL_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                   target_weights, bucket_id, False, config.probabilistic)
-
-      if config.anneal and model.global_step.eval() > config.kl_rate_rise_time and model.kl_rate < 1:
+                                   target_weights, bucket_id, False, config.probabilistic,
+                                   run_metadata=run_metadata)
+      # With gradient accumulation the step only accumulated the gradients of
+      # the batch; every accumulate_steps batches they make one update, and
+      # only updates advance the global step and the KL rate.
+      updated = True
+      if model.apply_accumulated is not None:
+        accumulated_steps += 1
+        updated = accumulated_steps % model.accumulate_steps == 0
+        if updated:
+          sess.run(model.apply_accumulated)
+
+      if updated and config.anneal and model.global_step.eval() > config.kl_rate_rise_time and model.kl_rate < 1:
         new_kl_rate = model.kl_rate.eval() + config.kl_rate_rise_factor
         sess.run(model.kl_rate_update, feed_dict={'new_kl_rate': new_kl_rate})
 
-      step_time += (time.time() - start_time) / config.steps_per_checkpoint
+      step_time += time.time() - start_time
       step_loss_summaries.append(tf.Summary(value=[tf.Summary.Value(tag="step loss", simple_value=float(step_loss))]))
       step_KL_loss_summaries.append(tf.Summary(value=[tf.Summary.Value(tag="KL step loss", simple_value=float(step_KL_loss))]))
-      loss += step_loss / config.steps_per_checkpoint
-      KL_loss += step_KL_loss / config.steps_per_checkpoint
-      current_step = model.global_step.eval()
+      loss += step_loss
+      KL_loss += step_KL_loss
+      local_steps += 1
+      previous_step, current_step = current_step, model.global_step.eval()
 
       # Once in a while, we save checkpoint, print statistics, and run evals.
-      if current_step % config.steps_per_checkpoint == 0:
+      # Other workers of a cluster advance the global step too, so this is
+      # whenever it has passed a multiple of steps_per_checkpoint.
+      if (current_step // config.steps_per_checkpoint >
+          previous_step // config.steps_per_checkpoint):
+        # Step-time is per update, losses are per batch.
+        step_time, loss, KL_loss = (
+            step_time * model.accumulate_steps / local_steps,
+            loss / local_steps, KL_loss / local_steps)
         # Print statistics for the previous epoch.
         perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
         print ("global step %d learning rate %.4f step-time %.2f perplexity "
                "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
                          step_time, perplexity))
+        if run_metadata is not None:
+          print("  tower step-times: %s" % " ".join(
+              "%.3f" % t if t is not None else "-"
+              for t in model.tower_times(run_metadata)))
+        if batcher:
+          batch_padding, bucket_padding = batcher.padded_fractions()
+          print("  epoch %d padded-token fraction %.3f (%.3f padded to buckets)"
+                % (batcher.epoch, batch_padding, bucket_padding))
 
         print ("global step %d learning rate %.4f step-time %.2f KL divergence "
                "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
                          step_time, KL_loss))
         wall_time = time.time() - overall_start_time
         print("time passed: {0}".format(wall_time))
+        if not is_chief:
+          step_time, loss, KL_loss, local_steps = 0.0, 0.0, 0.0, 0
+          step_loss_summaries, step_KL_loss_summaries = [], []
+          continue
 
         # Add perplexity, KL divergence to summary and stats.
         perp_summary = tf.Summary(value=[tf.Summary.Value(tag="train perplexity", simple_value=perplexity)])
@@ -247,8 +654,11 @@ def train(config):
 
         # Save checkpoint and zero timer and loss.
         checkpoint_path = os.path.join(FLAGS.model_dir, FLAGS.model_name + ".ckpt")
-        model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-        step_time, loss, KL_loss = 0.0, 0.0, 0.0
+        checkpoint_file = model.saver.save(sess, checkpoint_path,
+                                           global_step=model.global_step)
+        if batcher and not FLAGS.job_name:
+          _save_sampler(batcher, position, checkpoint_file)
+        step_time, loss, KL_loss, local_steps = 0.0, 0.0, 0.0, 0
 
         # Run evals on development set and print their perplexity.
         eval_losses = []
@@ -283,6 +693,210 @@ def train(config):
         dev_writer.add_summary(eval_KL_loss_summary, current_step)
 
 
+def _print_bucket_plan(name, plan):
+  print("%s buckets %s: %d graph steps, %.1f%% padding, %d of %d sentences dropped."
+        % (name, plan.buckets, plan.graph_steps, 100 * plan.padded_fraction,
+           plan.dropped, plan.num_sentences))
+
+
+def plan_buckets(config):
+  """Choose buckets for the training data and write them to config.json."""
+  en_train, fr_train, _, _, _, _ = data_utils.prepare_wmt_data(
+      config.data_dir, config.en_vocab_size, config.fr_vocab_size, config.load_embeddings,
+      binary=config.binary_ids, num_workers=config.preprocess_workers,
+      cache_size=config.token_cache_size, archive=config.data_archive)
+  histogram = bucket_utils.length_histogram(en_train, fr_train,
+                                            binary=config.binary_ids)
+  _print_bucket_plan("Current", bucket_utils.evaluate_buckets(histogram, config.buckets))
+  plan = bucket_utils.plan_buckets(histogram, config.num_buckets,
+                                   config.max_length, config.max_graph_steps)
+  _print_bucket_plan("Planned", plan)
+
+  config_path = os.path.join(FLAGS.model_dir, "config.json")
+  update_config_file(config_path, ["model", "buckets"], plan.buckets)
+  print("Wrote buckets to %s." % config_path)
+
+
+_JSON_SPACE = re.compile(r"\s*")
+_JSON_INDENT = re.compile(r"[ \t]*")
+
+
+def _json_members(text, start):
+  """Members of the JSON object at text[start] and the index of its "}".
+
+  Every member is a tuple (key, key_start, value_start, value_end) of
+  indices into text.
+  """
+  decoder = json.JSONDecoder()
+  members = []
+  i = _JSON_SPACE.match(text, start + 1).end()
+  while text[i] != "}":
+    key, key_end = decoder.raw_decode(text, i)
+    colon = _JSON_SPACE.match(text, key_end).end()
+    value_start = _JSON_SPACE.match(text, colon + 1).end()
+    _, value_end = decoder.raw_decode(text, value_start)
+    members.append((key, i, value_start, value_end))
+    i = _JSON_SPACE.match(text, value_end).end()
+    if text[i] == ",":
+      i = _JSON_SPACE.match(text, i + 1).end()
+  return members, i
+
+
+def _set_json_entry(text, path, value):
+  """Sets the entry at path of the JSON object in text to value.
+
+  Only the text of that entry changes, so the formatting of the rest is
+  kept. Missing entries along path are added as new members of their
+  object, indented like its other members.
+  """
+  start = _JSON_SPACE.match(text).end()
+  for depth, key in enumerate(path):
+    last = depth == len(path) - 1
+    members, end = _json_members(text, start)
+    for member_key, _, value_start, value_end in members:
+      if member_key == key:
+        if last:
+          return text[:value_start] + json.dumps(value) + text[value_end:]
+        start = value_start
+        break
+    else:
+      entry = "%s: %s" % (json.dumps(key), json.dumps(value) if last else "{}")
+      if members:
+        _, key_start, _, position = members[-1]
+        indent = text[text.rfind("\n", 0, key_start) + 1:key_start]
+        text = text[:position] + ",\n" + indent + entry + text[position:]
+        position += len(",\n" + indent)
+      else:
+        indent = _JSON_INDENT.match(
+            text, text.rfind("\n", 0, start) + 1).group()
+        text = (text[:start + 1] + "\n" + indent + "  " + entry + "\n" +
+                indent + text[end:])
+        position = start + len("\n" + indent + "  ") + 1
+      if last:
+        return text
+      start = position + len(entry) - len("{}")
+  return text
+
+
+def update_config_file(config_path, path, value):
+  """Sets the entry at path, e.g. ["model", "buckets"], of a config file.
+
+  The rest of the file, including its formatting, is left as it is.
+  """
+  with open(config_path) as config_file:
+    text = config_file.read()
+  with open(config_path, "w") as config_file:
+    config_file.write(_set_json_entry(text, path, value))
+
+
+def _probe_data(config, batch_size):
+  """Random examples that fill every bucket, batch_size of each."""
+  rng = np.random.RandomState(0)
+  data_set = []
+  for source_size, target_size in config.buckets:
+    data_set.append([
+        [rng.randint(data_utils.UNK_ID + 1, config.en_vocab_size,
+                     size=source_size - 1).tolist(),
+         rng.randint(data_utils.UNK_ID + 1, config.fr_vocab_size,
+                     size=target_size - 2).tolist() + [data_utils.EOS_ID]]
+        for _ in xrange(batch_size)])
+  return data_set
+
+
+def _probe(config, forward_only, batch_size, steps, warmup_steps):
+  """Seconds per step of the model in config, over all buckets."""
+  with tf.Graph().as_default():
+    session_config = make_session_config(
+        config, device_count={"CPU": config.num_towers})
+    with tf.Session(config=session_config) as sess:
+      model = _build_model(config, forward_only)
+      sess.run(tf.global_variables_initializer())
+      if model.accumulator_init is not None:
+        sess.run(model.accumulator_init)
+      model.batch_size = batch_size
+      data_set = _probe_data(config, batch_size)
+      batches = [(bucket_id, model.get_batch(data_set, bucket_id))
+                 for bucket_id in xrange(len(config.buckets))]
+
+      def run_steps(num_steps):
+        for _ in xrange(num_steps):
+          for bucket_id, (encoder_inputs, decoder_inputs,
+                          target_weights) in batches:
+            model.step(sess, encoder_inputs, decoder_inputs, target_weights,
+                       bucket_id, forward_only, config.probabilistic)
+      run_steps(warmup_steps)
+      start_time = time.time()
+      run_steps(steps)
+      return (time.time() - start_time) / (steps * len(batches))
+
+
+# Prefix of the line a probe process reports its step times on.
+_PROBE_TIMES = "probe step-times: "
+
+
+def run_probe(config, train_config, infer_config, profile):
+  """Time the session settings in profile and print the step times.
+
+  This runs in a process of its own for every profile, see autotune.
+  """
+  train_config.update(**profile)
+  infer_config.update(**profile)
+  train_time = _probe(train_config, False, train_config.batch_size,
+                      config.probe_steps, config.warmup_steps)
+  infer_time = _probe(infer_config, True, 1, config.probe_steps,
+                      config.warmup_steps)
+  print(_PROBE_TIMES + json.dumps([train_time, infer_time]))
+
+
+def _probe_process(profile):
+  """Training and inference step-times of profile, probed by a new process."""
+  output = subprocess.check_output(
+      [sys.executable] + sys.argv + ["--probe=%s" % json.dumps(profile)])
+  for line in output.decode("utf-8").splitlines():
+    if line.startswith(_PROBE_TIMES):
+      return tuple(json.loads(line[len(_PROBE_TIMES):]))
+  raise RuntimeError("Probe of %s reported no step-times." % json.dumps(profile))
+
+
+def autotune(config):
+  """Probe session settings and write the fastest to config.json.
+
+  Every combination of config.intra_op_threads, config.inter_op_threads and
+  config.opt_levels is timed on a few training steps of batch_size random
+  examples and a few inference steps of single examples, in every bucket.
+  Thread pools are sized by the first session of a process, so each
+  combination is timed by a process of its own. Settings are ranked by the
+  sum of their training and inference times, each relative to the fastest
+  setting for it.
+  """
+  profiles = [collections.OrderedDict([
+      ("intra_op_parallelism_threads", intra),
+      ("inter_op_parallelism_threads", inter),
+      ("opt_level", opt_level)])
+              for intra in config.intra_op_threads
+              for inter in config.inter_op_threads
+              for opt_level in config.opt_levels]
+  times = []
+  for profile in profiles:
+    train_time, infer_time = _probe_process(profile)
+    print("intra-op threads %d inter-op threads %d %s: train step-time %.4f "
+          "inference step-time %.4f" % (tuple(profile.values()) +
+                                        (train_time, infer_time)))
+    times.append((train_time, infer_time))
+  best_train = min(train_time for train_time, _ in times)
+  best_infer = min(infer_time for _, infer_time in times)
+  scores = [train_time / best_train + infer_time / best_infer
+            for train_time, infer_time in times]
+  best = profiles[scores.index(min(scores))]
+  print("Fastest: intra-op threads %d inter-op threads %d %s."
+        % tuple(best.values()))
+
+  config_path = os.path.join(FLAGS.model_dir, "config.json")
+  for key, value in best.items():
+    update_config_file(config_path, ["session", key], value)
+  print("Wrote session settings to %s." % config_path)
+
+
 def reconstruct(sess, model, config):
   model.batch_size = 1  # We decode one sentence at a time.
   model.probabilistic = config.probabilistic
@@ -293,8 +907,9 @@ def reconstruct(sess, model, config):
                                "vocab%d.in" % config.en_vocab_size)
   fr_vocab_path = os.path.join(config.data_dir,
                                "vocab%d.out" % config.fr_vocab_size)
-  en_vocab, _ = data_utils.initialize_vocabulary(en_vocab_path)
-  _, rev_fr_vocab = data_utils.initialize_vocabulary(fr_vocab_path)
+  en_vocab = data_utils.load_vocabulary(en_vocab_path)
+  rev_fr_vocab = data_utils.load_vocabulary(fr_vocab_path)
+  token_id_cache = data_utils.TokenIdCache(en_vocab, config.token_cache_size)
 
   # Decode from standard input.
   outputs = []
@@ -302,7 +917,7 @@ def reconstruct(sess, model, config):
     sentences = fs.readlines()
   for i, sentence in  enumerate(sentences):
     # Get token-ids for the input sentence.
-    token_ids = data_utils.sentence_to_token_ids(sentence, en_vocab)
+    token_ids = token_id_cache.sentence_to_token_ids(sentence)
     # Which bucket does it belong to?
     bucket_id = len(config.buckets) - 1
     for i, bucket in enumerate(config.buckets):
@@ -352,22 +967,21 @@ def reconstruct(sess, model, config):
   with gfile.GFile(FLAGS.output, "w") as enc_dec_f:
     for output in outputs:
       enc_dec_f.write(output)
+  print("token-id cache: %s" % token_id_cache.stats())
 
 
 def encode(sess, model, config, sentences):
-  # Load vocabularies.
+  # Load vocabulary.
   en_vocab_path = os.path.join(config.data_dir,
                                "vocab%d.in" % config.en_vocab_size)
-  fr_vocab_path = os.path.join(config.data_dir,
-                               "vocab%d.out" % config.fr_vocab_size)
-  en_vocab, _ = data_utils.initialize_vocabulary(en_vocab_path)
-  _, rev_fr_vocab = data_utils.initialize_vocabulary(fr_vocab_path)
+  en_vocab = data_utils.load_vocabulary(en_vocab_path)
+  token_id_cache = data_utils.TokenIdCache(en_vocab, config.token_cache_size)
   
   means = []
   logvars = []
   for i, sentence in enumerate(sentences):
     # Get token-ids for the input sentence.
-    token_ids = data_utils.sentence_to_token_ids(sentence, en_vocab)
+    token_ids = token_id_cache.sentence_to_token_ids(sentence)
     # Which bucket does it belong to?
     bucket_id = len(config.buckets) - 1
     for i, bucket in enumerate(config.buckets):
@@ -384,6 +998,7 @@ def encode(sess, model, config, sentences):
     mean, logvar = model.encode_to_latent(sess, encoder_inputs, bucket_id)
     means.append(mean)
     logvars.append(logvar)
+  print("token-id cache: %s" % token_id_cache.stats())
 
   return means, logvars
 
@@ -391,7 +1006,7 @@ def encode(sess, model, config, sentences):
 def decode(sess, model, config, means, logvars, bucket_id):
   fr_vocab_path = os.path.join(config.data_dir,
                                "vocab%d.out" % config.fr_vocab_size)
-  _, rev_fr_vocab = data_utils.initialize_vocabulary(fr_vocab_path)
+  rev_fr_vocab = data_utils.load_vocabulary(fr_vocab_path)
 
   _, decoder_inputs, target_weights = model.get_batch(
       {bucket_id: [([], [])]}, bucket_id)
@@ -472,6 +1087,75 @@ class Struct(object):
       self.__dict__.update({ "learning_rate": 0.001 })
     if not self.__dict__.get("anneal"):
       self.__dict__.update({ "anneal": False })
+    if not self.__dict__.get("kl_rate_rise_factor"):
+      self.__dict__.update({ "kl_rate_rise_factor": None })
+    if not self.__dict__.get("dynamic_encoder"):
+      self.__dict__.update({ "dynamic_encoder": False })
+    if not self.__dict__.get("single_graph"):
+      self.__dict__.update({ "single_graph": False })
+    if not self.__dict__.get("fused_loss"):
+      self.__dict__.update({ "fused_loss": False })
+    if not self.__dict__.get("cell_backend"):
+      self.__dict__.update({ "cell_backend": "default" })
+    if not self.__dict__.get("num_towers"):
+      self.__dict__.update({ "num_towers": 1 })
+    if not self.__dict__.get("accumulate_steps"):
+      self.__dict__.update({ "accumulate_steps": 1 })
+    if not self.__dict__.get("ps_hosts"):
+      self.__dict__.update({ "ps_hosts": [] })
+    if not self.__dict__.get("worker_hosts"):
+      self.__dict__.update({ "worker_hosts": [] })
+    if not self.__dict__.get("sync_replicas"):
+      self.__dict__.update({ "sync_replicas": False })
+    if self.__dict__.get("intra_op_parallelism_threads") is None:
+      self.__dict__.update({ "intra_op_parallelism_threads": 0 })
+    if self.__dict__.get("inter_op_parallelism_threads") is None:
+      self.__dict__.update({ "inter_op_parallelism_threads": 0 })
+    if not self.__dict__.get("opt_level"):
+      self.__dict__.update({ "opt_level": "L1" })
+    if not self.__dict__.get("intra_op_threads"):
+      self.__dict__.update({ "intra_op_threads": [0, 1, 2, 4] })
+    if not self.__dict__.get("inter_op_threads"):
+      self.__dict__.update({ "inter_op_threads": [0, 1, 2] })
+    if not self.__dict__.get("opt_levels"):
+      self.__dict__.update({ "opt_levels": ["L1"] })
+    if not self.__dict__.get("probe_steps"):
+      self.__dict__.update({ "probe_steps": 5 })
+    if self.__dict__.get("warmup_steps") is None:
+      self.__dict__.update({ "warmup_steps": 2 })
+    if not self.__dict__.get("graph_cache"):
+      self.__dict__.update({ "graph_cache": None })
+    if not self.__dict__.get("data_archive"):
+      self.__dict__.update({ "data_archive": None })
+    if not self.__dict__.get("binary_ids"):
+      self.__dict__.update({ "binary_ids": False })
+    if self.__dict__.get("prefetch_queue_depth") is None:
+      self.__dict__.update({ "prefetch_queue_depth": 8 })
+    if not self.__dict__.get("prefetch_threads"):
+      self.__dict__.update({ "prefetch_threads": 1 })
+    if not self.__dict__.get("preprocess_workers"):
+      self.__dict__.update({ "preprocess_workers": 1 })
+    if not self.__dict__.get("streaming"):
+      self.__dict__.update({ "streaming": False })
+    if not self.__dict__.get("shuffle_buffer_size"):
+      self.__dict__.update({ "shuffle_buffer_size": 10000 })
+    if self.__dict__.get("compact_buckets") is None:
+      # Binary corpora stay memory-mapped; compacting them would copy them.
+      self.__dict__.update({ "compact_buckets": not self.binary_ids })
+    if self.__dict__.get("dedup_examples") is None:
+      self.__dict__.update({ "dedup_examples": True })
+    if self.__dict__.get("token_cache_size") is None:
+      self.__dict__.update({ "token_cache_size": 10000 })
+    if not self.__dict__.get("batching"):
+      self.__dict__.update({ "batching": "random" })
+    if not self.__dict__.get("sort_chunk_batches"):
+      self.__dict__.update({ "sort_chunk_batches": 100 })
+    if not self.__dict__.get("num_buckets"):
+      self.__dict__.update({ "num_buckets": 4 })
+    if not self.__dict__.get("max_length"):
+      self.__dict__.update({ "max_length": 50 })
+    if not self.__dict__.get("max_graph_steps"):
+      self.__dict__.update({ "max_graph_steps": 0 })
     if not self.__dict__.get("beam_size"):
       self.__dict__.update({ "beam_size": 1 })
     if self.__dict__.get("beam_size") > 1:
@@ -486,36 +1170,64 @@ def main(_):
     configs = json.load(config_file)
 
   FLAGS.model_name = os.path.basename(os.path.normpath(FLAGS.model_dir)) 
-  behavior = ["train", "interpolate", "reconstruct", "sample"]
+  behavior = ["train", "interpolate", "reconstruct", "sample", "plan_buckets",
+              "autotune", "export"]
   if FLAGS.do not in behavior:
-    raise ValueError("argument \"do\" is not one of the following: train, interpolate, decode or sample.")
+    raise ValueError("argument \"do\" is not one of the following: train, interpolate, reconstruct, sample, plan_buckets, autotune or export.")
 
   if FLAGS.do != "train":
     FLAGS.new = False
+  if FLAGS.job_name not in ("", "ps", "worker"):
+    raise ValueError("argument \"job_name\" is not one of the following: ps or worker.")
 
+  # Session settings apply to every session.
+  session = configs.get("session", {})
   config = Struct(**configs["model"])
-  config.update(**configs[FLAGS.do])
+  config.update(**configs.get(FLAGS.do, {}))
+  config.update(**session)
   interp_config = Struct(**configs["model"])
   interp_config.update(**configs["interpolate"])
+  interp_config.update(**session)
   enc_dec_config = Struct(**configs["model"])
   enc_dec_config.update(**configs["reconstruct"])
+  enc_dec_config.update(**session)
   sample_config = Struct(**configs["model"])
   sample_config.update(**configs["sample"])
+  sample_config.update(**session)
 
   if FLAGS.do == "reconstruct":
-    with tf.Session() as sess:
-      model = create_model(sess, enc_dec_config, True)
+    with tf.Session(config=make_session_config(enc_dec_config)) as sess:
+      model = load_inference_model(sess, enc_dec_config)
       reconstruct(sess, model, enc_dec_config)
   elif FLAGS.do == "interpolate":
-    with tf.Session() as sess:
-      model = create_model(sess, interp_config, True)
+    with tf.Session(config=make_session_config(interp_config)) as sess:
+      model = load_inference_model(sess, interp_config)
       encode_interpolate(sess, model, interp_config)
   elif FLAGS.do == "sample":
-    with tf.Session() as sess:
-      model = create_model(sess, sample_config, True)
+    with tf.Session(config=make_session_config(sample_config)) as sess:
+      model = load_inference_model(sess, sample_config)
       n_sample(sess, model, config)
   elif FLAGS.do == "train":
-    train(config)
+    if FLAGS.job_name == "ps":
+      run_parameter_server(config)
+    elif FLAGS.job_name == "worker" or not config.worker_hosts:
+      train(config)
+    else:
+      launch_local(config)
+  elif FLAGS.do == "plan_buckets":
+    plan_buckets(config)
+  elif FLAGS.do == "export":
+    # The exported graph decodes with the reconstruct settings.
+    with tf.Session(config=make_session_config(enc_dec_config)) as sess:
+      model = create_model(sess, enc_dec_config, True)
+      export(sess, model, enc_dec_config)
+  elif FLAGS.do == "autotune":
+    if FLAGS.probe:
+      train_config = Struct(**configs["model"])
+      train_config.update(**configs["train"])
+      run_probe(config, train_config, enc_dec_config, json.loads(FLAGS.probe))
+    else:
+      autotune(config)
 
 if __name__ == "__main__":
   tf.app.run()